@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+Compare the speed of the image conversion functions of paperwork.util with
+the ones they replaced (PNG / PPM round-trips).
+
+Usage: bench_conversions.py [<image file>]
+"""
+
+import StringIO
+import sys
+import timeit
+
+import cairo
+import Image
+from gi.repository import GdkPixbuf
+
+import paperwork.util as util
+
+
+def old_image2surface(img):
+    file_desc = StringIO.StringIO()
+    img.save(file_desc, format="PNG")
+    file_desc.seek(0)
+    return cairo.ImageSurface.create_from_png(file_desc)
+
+
+def old_surface2image(surface):
+    dimension = (surface.get_width(), surface.get_height())
+    img = Image.frombuffer("RGBA", dimension,
+                           surface.get_data(), "raw", "BGRA", 0, 1)
+    background = Image.new("RGB", img.size, (255, 255, 255))
+    background.paste(img, mask=img.split()[3])
+    return background
+
+
+def old_image2pixbuf(img):
+    file_desc = StringIO.StringIO()
+    img.save(file_desc, "ppm")
+    contents = file_desc.getvalue()
+    file_desc.close()
+    loader = GdkPixbuf.PixbufLoader.new_with_type("pnm")
+    loader.write(contents)
+    pixbuf = loader.get_pixbuf()
+    loader.close()
+    return pixbuf
+
+
+def bench(name, func, arg, number):
+    duration = timeit.timeit(lambda: func(arg), number=number)
+    print "%-30s: %8.2f ms" % (name, duration * 1000.0 / number)
+
+
+def main():
+    if len(sys.argv) > 1:
+        img = Image.open(sys.argv[1])
+        img.load()
+    else:
+        # roughly a A4 page scanned at 300dpi
+        img = Image.new("RGB", (2480, 3508), (255, 255, 255))
+    img = img.convert("RGB")
+    thumbnail = img.resize((150, int(img.size[1] * 150 / img.size[0])))
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                 img.size[0], img.size[1])
+    surface_rgb = cairo.ImageSurface(cairo.FORMAT_RGB24,
+                                     img.size[0], img.size[1])
+
+    print "Image: %dx%d" % img.size
+    print ""
+    for (label, arg, number) in [("page", img, 5),
+                                 ("thumbnail", thumbnail, 200)]:
+        bench("old image2pixbuf (%s)" % label, old_image2pixbuf, arg, number)
+        bench("new image2pixbuf (%s)" % label, util.image2pixbuf, arg,
+              number)
+        bench("old image2surface (%s)" % label, old_image2surface, arg,
+              number)
+        bench("new image2surface (%s)" % label, util.image2surface, arg,
+              number)
+        print ""
+    bench("old surface2image (ARGB32)", old_surface2image, surface, 5)
+    bench("new surface2image (ARGB32)", util.surface2image, surface, 5)
+    bench("new surface2image (RGB24)", util.surface2image, surface_rgb, 5)
+
+
+if __name__ == "__main__":
+    main()
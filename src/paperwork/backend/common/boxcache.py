@@ -0,0 +1,209 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary cache of the boxes stored in the 'paper.<X>.words' files (or
+extracted from any other file, for instance a PDF file).
+
+Parsing the hOCR files is slow. So once a box file has been parsed, its
+content is written next to it in a compact binary format, that can be
+mapped in memory and turned back into boxes quickly:
+
+    header: magic, version, mtime and size of the box file, number of lines,
+        number of words, size of the string blob
+    lines: for each line, its position (x0, y0, x1, y1), the index of its
+        first word and its number of words (int32)
+    words: for each word, its position (x0, y0, x1, y1), and the offset and
+        the length of its content in the string blob (int32)
+    string blob: the contents of all the words, UTF-8 encoded
+
+The cache is ignored (and rebuilt) as soon as the mtime or the size of the
+box file doesn't match the ones recorded in the header.
+"""
+
+import array
+import codecs
+import mmap
+import os
+import struct
+import sys
+
+import pyocr.builders
+
+
+MAGIC = "PWBX"
+VERSION = 1
+
+_HEADER = struct.Struct("<4sIdQIII")
+_LINE_FIELDS = 6
+_WORD_FIELDS = 6
+_INT_SIZE = 4
+
+
+def _get_file_signature(path):
+    stat = os.stat(path)
+    return (stat.st_mtime, stat.st_size)
+
+
+def _new_int_array():
+    int_array = array.array('i')
+    assert(int_array.itemsize == _INT_SIZE)
+    return int_array
+
+
+def _read_int_array(buf, offset, nb_ints):
+    int_array = _new_int_array()
+    int_array.fromstring(buf[offset:offset + (nb_ints * _INT_SIZE)])
+    if sys.byteorder != 'little':
+        int_array.byteswap()
+    return int_array
+
+
+def _read_cache(cache_path, signature):
+    """
+    Returns:
+        The boxes stored in the cache. None if the cache is missing, invalid
+        or outdated.
+    """
+    try:
+        with open(cache_path, 'rb') as file_desc:
+            if os.fstat(file_desc.fileno()).st_size < _HEADER.size:
+                return None
+            buf = mmap.mmap(file_desc.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, mmap.error):
+        return None
+
+    try:
+        (magic, version, mtime, size, nb_lines, nb_words, blob_len) = \
+            _HEADER.unpack_from(buf, 0)
+        if (magic != MAGIC or version != VERSION
+                or (mtime, size) != signature):
+            return None
+        offset = _HEADER.size
+        lines = _read_int_array(buf, offset, nb_lines * _LINE_FIELDS)
+        offset += nb_lines * _LINE_FIELDS * _INT_SIZE
+        words = _read_int_array(buf, offset, nb_words * _WORD_FIELDS)
+        offset += nb_words * _WORD_FIELDS * _INT_SIZE
+        blob = buf[offset:offset + blob_len]
+        if (len(lines) != nb_lines * _LINE_FIELDS
+                or len(words) != nb_words * _WORD_FIELDS
+                or len(blob) != blob_len):
+            return None
+    except struct.error:
+        return None
+    finally:
+        buf.close()
+
+    boxes = []
+    for line_idx in xrange(0, nb_lines * _LINE_FIELDS, _LINE_FIELDS):
+        (x0, y0, x1, y1, first_word, line_nb_words) = \
+            lines[line_idx:line_idx + _LINE_FIELDS]
+        word_boxes = []
+        for word_idx in xrange(first_word * _WORD_FIELDS,
+                               (first_word + line_nb_words) * _WORD_FIELDS,
+                               _WORD_FIELDS):
+            (wx0, wy0, wx1, wy1, str_offset, str_len) = \
+                words[word_idx:word_idx + _WORD_FIELDS]
+            content = blob[str_offset:str_offset + str_len].decode('utf-8')
+            word_boxes.append(pyocr.builders.Box(content,
+                                                 ((wx0, wy0), (wx1, wy1))))
+        boxes.append(pyocr.builders.LineBox(word_boxes,
+                                            ((x0, y0), (x1, y1))))
+    return boxes
+
+
+def write_cache(cache_path, box_path, boxes):
+    """
+    Write the binary cache of the boxes read from (or just written in) the
+    box file 'box_path'. Failing to write the cache is not fatal.
+    """
+    lines = _new_int_array()
+    words = _new_int_array()
+    blob = []
+    blob_len = 0
+    nb_words = 0
+    for line in boxes:
+        ((x0, y0), (x1, y1)) = line.position
+        lines.extend((x0, y0, x1, y1, nb_words, len(line.word_boxes)))
+        for word in line.word_boxes:
+            content = word.content
+            if not isinstance(content, unicode):
+                content = content.decode('utf-8')
+            content = content.encode('utf-8')
+            ((wx0, wy0), (wx1, wy1)) = word.position
+            words.extend((wx0, wy0, wx1, wy1, blob_len, len(content)))
+            blob.append(content)
+            blob_len += len(content)
+            nb_words += 1
+    if sys.byteorder != 'little':
+        lines.byteswap()
+        words.byteswap()
+
+    try:
+        (mtime, size) = _get_file_signature(box_path)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'wb') as file_desc:
+            file_desc.write(_HEADER.pack(MAGIC, VERSION, mtime, size,
+                                         len(boxes), nb_words, blob_len))
+            lines.tofile(file_desc)
+            words.tofile(file_desc)
+            file_desc.write("".join(blob))
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError, struct.error), exc:
+        print "Unable to write box cache '%s': %s" % (cache_path, str(exc))
+
+
+def read_cache(cache_path, src_path):
+    """
+    Returns:
+        The boxes stored in the cache 'cache_path' for the file 'src_path'.
+        None if the cache is missing or outdated.
+    """
+    try:
+        signature = _get_file_signature(src_path)
+    except OSError:
+        return None
+    return _read_cache(cache_path, signature)
+
+
+def read_boxes(box_path, cache_path):
+    """
+    Read the boxes of the box file 'box_path'. Use the binary cache
+    'cache_path' if it is up-to-date. Otherwise, parse the box file and
+    rebuild the cache.
+
+    Raises:
+        IOError or OSError if the box file can't be read
+    """
+    signature = _get_file_signature(box_path)
+    boxes = _read_cache(cache_path, signature)
+    if boxes is not None:
+        return boxes
+
+    box_builder = pyocr.builders.LineBoxBuilder()
+    with codecs.open(box_path, 'r', encoding='utf-8') as file_desc:
+        boxes = box_builder.read_file(file_desc)
+    write_cache(cache_path, box_path, boxes)
+    return boxes
+
+
+def write_boxes(box_path, cache_path, boxes):
+    """
+    Write the boxes in the box file 'box_path' and update its binary cache
+    """
+    with codecs.open(box_path, 'w', encoding='utf-8') as file_desc:
+        pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
+    write_cache(cache_path, box_path, boxes)
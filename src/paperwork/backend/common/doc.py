@@ -23,6 +23,7 @@ import time
 
 from paperwork.backend.common.page import BasicPage
 from paperwork.backend.labels import Label
+from paperwork.backend.ocr import OCR_EXECUTOR
 from paperwork.util import dummy_progress_cb
 from paperwork.util import rm_rf
 
@@ -33,6 +34,8 @@ _ = gettext.gettext
 class BasicDoc(object):
     LABEL_FILE = "labels"
     DOCNAME_FORMAT = "%Y%m%d_%H%M_%S"
+    # date of the documents whose id doesn't contain a date
+    DEFAULT_DATE = (1985, 12, 19)
     EXTRA_TEXT_FILE = "extra.txt"
 
     pages = []
@@ -74,15 +77,16 @@ class BasicDoc(object):
 
     def redo_ocr(self, langs, callback=dummy_progress_cb):
         """
-        Run the OCR again on all the pages of the document
+        Run the OCR again on all the pages of the document. The pages are
+        processed in parallel by the OCR executor.
 
         Arguments
         """
-        nb_pages = self.nb_pages
-        for i in range(0, nb_pages):
-            callback(i, nb_pages, BasicPage.SCAN_STEP_OCR, self)
-            page = self.pages[i]
-            page.redo_ocr(langs)
+        callback(0, self.nb_pages, BasicPage.SCAN_STEP_OCR, self)
+        OCR_EXECUTOR.redo_ocr(
+            [(self, page_nb) for page_nb in range(0, self.nb_pages)], langs,
+            lambda progression, total, doc:
+            callback(progression, total, BasicPage.SCAN_STEP_OCR, doc))
 
     def print_page_cb(self, print_op, print_context, page_nb):
         raise NotImplementedError()
@@ -289,7 +293,7 @@ class BasicDoc(object):
                     int(split[4:6]),
                     int(split[6:8]))
         except (IndexError, ValueError):
-            return (1985, 12, 19)
+            return self.DEFAULT_DATE
 
     def __set_date(self, new_date):
         new_id = ("%02d%02d%02d_0000_01"
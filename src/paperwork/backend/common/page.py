@@ -14,13 +14,16 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import codecs
 from copy import copy
+import cPickle
 import Image
 import os
 import os.path
 import re
 
+from paperwork.backend.common.thumbnail import THUMBNAIL_CACHE
 from paperwork.util import split_words
 
 
@@ -97,6 +100,12 @@ class BasicPage(object):
     boxes = []
     img = None
 
+    # If True, the page implements get_zoomed_size(), get_tiles() and
+    # render_tile(): the GUI can render only the visible part of the page
+    can_render_tiles = False
+
+    WORD_MAP_VERSION = 1
+
     def __init__(self, doc, page_nb):
         """
         Don't create directly. Please use ImgDoc.get_page()
@@ -104,8 +113,9 @@ class BasicPage(object):
         self.doc = doc
         self.page_nb = page_nb
 
-        self.__thumbnail_cache = (None, 0)
         self.__text_cache = None
+        self.__word_map_cache = None
+        self.__suffixes_cache = None
 
         assert(self.page_nb >= 0)
         self.__prototype_exporters = {
@@ -119,18 +129,28 @@ class BasicPage(object):
     pageid = property(__get_pageid)
 
     def _get_thumbnail(self, width):
+        """
+        Generate a thumbnail of the page. Only called when there is no
+        up-to-date thumbnail in the thumbnail cache.
+        """
         raise NotImplementedError()
 
+    def _get_thumbnail_src_path(self):
+        """
+        Returns:
+            Path of the file the thumbnails are generated from. Its mtime is
+            used to invalidate them. None if the thumbnails must not be
+            cached.
+        """
+        return None
+
     def get_thumbnail(self, width):
-        if (width == self.__thumbnail_cache[1]):
-            return self.__thumbnail_cache[0]
-        thumbnail = self._get_thumbnail(width)
-        self.__thumbnail_cache = (thumbnail, width)
-        return thumbnail
+        return THUMBNAIL_CACHE.get_thumbnail(self, width)
 
     def drop_cache(self):
-        self.__thumbnail_cache = (None, 0)
         self.__text_cache = None
+        self.__word_map_cache = None
+        self.__suffixes_cache = None
 
     def __get_text(self):
         if self.__text_cache is not None:
@@ -149,6 +169,115 @@ class BasicPage(object):
     def destroy(self):
         raise NotImplementedError()
 
+    def _get_word_map_paths(self):
+        """
+        Returns:
+            (path of the file where the word map can be saved, path of the file
+            from which the boxes are read). None if the word map must not be
+            saved.
+        """
+        return None
+
+    @staticmethod
+    def __get_file_signature(path):
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size)
+
+    def __load_word_positions(self, paths):
+        """
+        Load the word positions saved by __save_word_positions(). Returns None
+        if they are missing or outdated.
+        """
+        (map_path, src_path) = paths
+        try:
+            with open(map_path, 'rb') as file_desc:
+                (version, signature, positions) = cPickle.load(file_desc)
+            if (version != self.WORD_MAP_VERSION
+                    or signature != self.__get_file_signature(src_path)):
+                return None
+            return positions
+        except (IOError, OSError, EOFError, ValueError,
+                cPickle.UnpicklingError):
+            return None
+
+    def __save_word_positions(self, paths, positions):
+        (map_path, src_path) = paths
+        try:
+            signature = self.__get_file_signature(src_path)
+            tmp_path = map_path + ".tmp"
+            with open(tmp_path, 'wb') as file_desc:
+                cPickle.dump((self.WORD_MAP_VERSION, signature, positions),
+                             file_desc, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, map_path)
+        except (IOError, OSError), exc:
+            print "Unable to save word map of %s: %s" % (str(self), str(exc))
+
+    @staticmethod
+    def __find_word_positions(boxes):
+        """
+        Returns:
+            { keyword: [(line index, word box index), ...] }
+        """
+        positions = {}
+        for (line_idx, line) in enumerate(boxes):
+            for (box_idx, box) in enumerate(line.word_boxes):
+                for word in set(split_words(box.content)):
+                    if not word in positions:
+                        positions[word] = []
+                    positions[word].append((line_idx, box_idx))
+        return positions
+
+    @staticmethod
+    def __positions_to_boxes(boxes, positions):
+        return dict([
+            (word, [boxes[line_idx].word_boxes[box_idx]
+                    for (line_idx, box_idx) in word_positions])
+            for (word, word_positions) in positions.iteritems()
+        ])
+
+    def __get_word_map(self):
+        """
+        Returns:
+            { keyword: [word box, ...] }
+        """
+        if self.__word_map_cache is not None:
+            return self.__word_map_cache
+
+        paths = self._get_word_map_paths()
+        positions = None
+        if paths is not None:
+            positions = self.__load_word_positions(paths)
+        boxes = self.boxes
+        word_map = None
+        if positions is not None:
+            try:
+                word_map = self.__positions_to_boxes(boxes, positions)
+            except IndexError:
+                print "Word map of %s doesn't match its boxes" % str(self)
+        if word_map is None:
+            positions = self.__find_word_positions(boxes)
+            if paths is not None:
+                self.__save_word_positions(paths, positions)
+            word_map = self.__positions_to_boxes(boxes, positions)
+        self.__word_map_cache = word_map
+        self.__suffixes_cache = sorted([
+            (word[start:], word)
+            for word in word_map.iterkeys()
+            for start in xrange(0, len(word))
+        ])
+        return word_map
+
+    def __get_suffixes(self):
+        """
+        Returns:
+            [(suffix, keyword), ...] for all the suffixes of all the keywords
+            of the word map, sorted. Keywords containing a given string are
+            the ones with a suffix starting with it.
+        """
+        if self.__suffixes_cache is None:
+            self.__get_word_map()
+        return self.__suffixes_cache
+
     def get_boxes(self, sentence):
         """
         Get all the boxes corresponding the given sentence
@@ -165,18 +294,23 @@ class BasicPage(object):
             assert(isinstance(sentence, list))
             keywords = sentence
 
+        word_map = self.__get_word_map()
+        suffixes = self.__get_suffixes()
         output = []
         for keyword in keywords:
-            for line in self.boxes:
-                for box in line.word_boxes:
-                    if keyword in box.content:
-                        output.append(box)
-                        continue
-                    # unfold generator output
-                    words = [x for x in split_words(box.content)]
-                    if keyword in words:
-                        output.append(box)
-                        continue
+            boxes = word_map.get(keyword, [])[:]
+            # keywords may also be only a part of words (for instance, the
+            # beginning of a word when searching as the user types)
+            seen = set([id(box) for box in boxes])
+            idx = bisect.bisect_left(suffixes, (keyword, u""))
+            while (idx < len(suffixes)
+                   and suffixes[idx][0].startswith(keyword)):
+                for box in word_map[suffixes[idx][1]]:
+                    if not id(box) in seen:
+                        seen.add(id(box))
+                        boxes.append(box)
+                idx += 1
+            output += boxes
         return output
 
     def get_export_formats(self):
@@ -225,6 +359,7 @@ class BasicPage(object):
 class DummyPage(object):
     page_nb = -1
     text = ""
+    can_render_tiles = False
     boxes = []
     keywords = []
     img = None
@@ -0,0 +1,199 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Page thumbnail cache.
+
+Thumbnails are identified by (docid, page number, signature of the file they
+are generated from, width). The signature is made of the mtime, the size and
+the inode number of the file: on some filesystems, the mtimes are too coarse
+to notice that a page has been replaced or that pages have been reordered.
+
+Thumbnails are kept in memory (LRU) and on the disk, in
+$XDG_CACHE_HOME/paperwork/thumbnails, in one directory per document. The
+size and the inode number of the source file are part of the name of the
+thumbnail file, and the mtime of a thumbnail file is set to the mtime of its
+source file: if they don't match anymore, the thumbnail is outdated and
+regenerated. The mtimes are compared with a small tolerance: os.utime()
+can't set the mtime with a nanosecond precision.
+
+The thumbnails of a document are removed from the disk when the document is
+removed from the index (see remove_doc()).
+"""
+
+import hashlib
+import os
+import tempfile
+
+import Image
+
+from paperwork.util import LRUCache
+from paperwork.util import mkdir_p
+from paperwork.util import rm_rf
+
+
+class ThumbnailCache(object):
+    MEM_CACHE_SIZE = 256
+    JPEG_QUALITY = 90
+    MTIME_TOLERANCE = 0.001  # seconds
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                os.getenv("XDG_CACHE_HOME",
+                          os.path.expanduser("~/.cache")),
+                "paperwork", "thumbnails")
+        self.cache_dir = cache_dir
+        self.__mem_cache = LRUCache(self.MEM_CACHE_SIZE)
+
+    def __get_doc_dir(self, docid):
+        if isinstance(docid, unicode):
+            docid = docid.encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(docid).hexdigest())
+
+    def __get_path(self, docid, page_nb, width, src_signature):
+        (src_mtime, src_size, src_inode) = src_signature
+        filename = "%d.%d.%d.%d.jpg" % (page_nb, width, src_size, src_inode)
+        return os.path.join(self.__get_doc_dir(docid), filename)
+
+    @classmethod
+    def __load(cls, path, src_signature):
+        """
+        Load a thumbnail from the disk. Returns None if it is missing or
+        outdated.
+        """
+        src_mtime = src_signature[0]
+        try:
+            if abs(os.stat(path).st_mtime - src_mtime) > cls.MTIME_TOLERANCE:
+                return None
+            img = Image.open(path)
+            img.load()
+            return img
+        except (IOError, OSError):
+            return None
+
+    def __save(self, path, src_signature, img):
+        src_mtime = src_signature[0]
+        doc_dir = os.path.dirname(path)
+        try:
+            mkdir_p(doc_dir)
+            (fd, tmp_path) = tempfile.mkstemp(suffix=".tmp", dir=doc_dir)
+            os.close(fd)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(tmp_path, "JPEG", quality=self.JPEG_QUALITY)
+            os.utime(tmp_path, (src_mtime, src_mtime))
+            os.rename(tmp_path, path)
+        except (IOError, OSError), exc:
+            print "Unable to save thumbnail '%s': %s" % (path, str(exc))
+            return
+        self.__remove_outdated(path)
+
+    @staticmethod
+    def __remove_outdated(path):
+        """
+        Remove the thumbnails of the same page, with the same width, but
+        generated from another version of the source file
+        """
+        (doc_dir, filename) = os.path.split(path)
+        prefix = ".".join(filename.split(".")[:2]) + "."
+        try:
+            for other in os.listdir(doc_dir):
+                if other.startswith(prefix) and other != filename:
+                    os.unlink(os.path.join(doc_dir, other))
+        except OSError, exc:
+            print ("Unable to remove outdated thumbnails in '%s': %s"
+                   % (doc_dir, str(exc)))
+
+    @staticmethod
+    def __get_src_signature(page):
+        """
+        Returns:
+            (mtime, size, inode number) of the file the thumbnails of the
+            page are generated from. None if unknown or missing: then we
+            can't tell if a thumbnail is still valid.
+        """
+        src_path = page._get_thumbnail_src_path()
+        if src_path is None:
+            return None
+        try:
+            stat = os.stat(src_path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+    def get_cached_thumbnail(self, page, width):
+        """
+        Returns a thumbnail of the page only if there is an up-to-date one in
+        memory. None otherwise.
+        """
+        src_signature = self.__get_src_signature(page)
+        if src_signature is None:
+            return None
+        key = (page.doc.docid, page.page_nb, src_signature, width)
+        img = self.__mem_cache.get(key)
+        if img is None:
+            return None
+        return img.copy()
+
+    def add_thumbnail(self, page, width, img):
+        """
+        Keep in memory a thumbnail generated somewhere else (for instance, in
+        another process)
+        """
+        src_signature = self.__get_src_signature(page)
+        if src_signature is None:
+            return
+        key = (page.doc.docid, page.page_nb, src_signature, width)
+        self.__mem_cache[key] = img.copy()
+
+    def get_thumbnail(self, page, width):
+        """
+        Returns a thumbnail of the page. It is generated with
+        page._get_thumbnail() only if there is no up-to-date one in the
+        cache.
+
+        Returns:
+            A PIL image. The caller is free to modify it.
+        """
+        src_signature = self.__get_src_signature(page)
+        if src_signature is None:
+            return page._get_thumbnail(width)
+
+        key = (page.doc.docid, page.page_nb, src_signature, width)
+        img = self.__mem_cache.get(key)
+        if img is None:
+            path = self.__get_path(page.doc.docid, page.page_nb, width,
+                                   src_signature)
+            img = self.__load(path, src_signature)
+            if img is None:
+                img = page._get_thumbnail(width)
+                self.__save(path, src_signature, img)
+            self.__mem_cache[key] = img
+        return img.copy()
+
+    def remove_doc(self, docid):
+        """
+        Remove from the disk all the thumbnails of a document. The ones
+        still in memory are simply left to expire.
+        """
+        try:
+            rm_rf(self.__get_doc_dir(docid))
+        except OSError, exc:
+            print ("Unable to remove the thumbnails of '%s': %s"
+                   % (docid, str(exc)))
+
+THUMBNAIL_CACHE = ThumbnailCache()
@@ -26,6 +26,10 @@ import pyinsane.abstract_th as pyinsane
 import pyocr.pyocr
 
 
+# see PaperworkConfig.max_open_pdfs
+DEFAULT_MAX_OPEN_PDFS = 64
+
+
 class _ScanTimes(object):
     """
     Helper to find, load and rewrite the scan times stored in the configuration
@@ -365,6 +369,27 @@ class PaperworkConfig(object):
 
     toolbar_visible = property(__get_toolbar_visible, __set_toolbar_visible)
 
+    def __get_max_open_pdfs(self):
+        """
+        Maximum number of PDF files kept open at the same time. The others
+        are reopened when required.
+
+        Integer.
+        """
+        try:
+            return int(self._configparser.get("Global", "MaxOpenPdfs"))
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError,
+                ValueError):
+            return DEFAULT_MAX_OPEN_PDFS
+
+    def __set_max_open_pdfs(self, max_open_pdfs):
+        """
+        Set the maximum number of PDF files kept open at the same time
+        """
+        self._configparser.set("Global", "MaxOpenPdfs", str(max_open_pdfs))
+
+    max_open_pdfs = property(__get_max_open_pdfs, __set_max_open_pdfs)
+
     def write(self):
         """
         Rewrite the configuration file. It rewrites the same file than
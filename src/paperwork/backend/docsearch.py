@@ -20,12 +20,13 @@ Also everything related to indexation and searching in the documents (+
 suggestions)
 """
 
+import collections
 import copy
 import datetime
 import multiprocessing
 import os
 import os.path
-import time
+import re
 import threading
 
 from gi.repository import GObject
@@ -35,11 +36,17 @@ import whoosh.qparser
 import whoosh.query
 
 from paperwork.backend import img
+from paperwork.backend.common.doc import BasicDoc
+from paperwork.backend.common.thumbnail import THUMBNAIL_CACHE
 from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.img.doc import is_img_doc
+from paperwork.backend.labels import Label
+from paperwork.backend.manifest import DocDirManifest
+from paperwork.backend.ocr import OCR_EXECUTOR
 from paperwork.backend.pdf.doc import PdfDoc
 from paperwork.backend.pdf.doc import is_pdf_doc
 from paperwork.util import dummy_progress_cb
+from paperwork.util import LRUCache
 from paperwork.util import MIN_KEYWORD_LEN
 from paperwork.util import mkdir_p
 from paperwork.util import rm_rf
@@ -75,6 +82,11 @@ class DummyDocSearch(object):
         """ Do nothing """
         assert()
 
+    @staticmethod
+    def flush_index():
+        """ Do nothing """
+        pass
+
     @staticmethod
     def find_suggestions(sentence):
         """ Do nothing """
@@ -82,9 +94,32 @@ class DummyDocSearch(object):
         return []
 
     @staticmethod
-    def find_documents(sentence):
+    def find_documents(sentence, as_you_type=False, sort=None):
         """ Do nothing """
-        sentence = sentence  # to make pylint happy
+        # to make pylint happy
+        sentence = sentence
+        as_you_type = as_you_type
+        sort = sort
+        return []
+
+    @staticmethod
+    def find_documents_paged(sentence, page_len=0, as_you_type=False,
+                             sort=None):
+        """ Do nothing """
+        # to make pylint happy
+        sentence = sentence
+        page_len = page_len
+        as_you_type = as_you_type
+        sort = sort
+        return DocSearchResults(lambda docid: None, [], 0, lambda: [])
+
+    @staticmethod
+    def find_pages(sentence, docid=None, as_you_type=False):
+        """ Do nothing """
+        # to make pylint happy
+        sentence = sentence
+        docid = docid
+        as_you_type = as_you_type
         return []
 
     @staticmethod
@@ -145,7 +180,12 @@ class DocDirExaminer(GObject.GObject):
         Examine the rootdir.
         Calls on_new_doc(doc), on_doc_modified(doc), on_doc_deleted(docid)
         every time a new, modified, or deleted document is found
+
+        Documents whose directory hasn't changed since they were last indexed
+        (see DocDirManifest) are not even instantiated.
         """
+        manifest = self.docsearch.manifest
+
         # getting the doc list from the index
         query = whoosh.query.Every()
         results = self.__searcher.search(query, limit=None)
@@ -160,6 +200,13 @@ class DocDirExaminer(GObject.GObject):
         docdirs = os.listdir(self.docsearch.rootdir)
         progress = 0
         for docdir in docdirs:
+            if (docdir in old_doc_list and manifest.is_unchanged(
+                    docdir, os.path.join(self.docsearch.rootdir, docdir))):
+                old_doc_list.remove(docdir)
+                progress_cb(progress, len(docdirs),
+                            DocSearch.INDEX_STEP_CHECKING)
+                progress += 1
+                continue
             old_infos = old_doc_infos.get(docdir)
             doctype = None
             if old_infos is not None:
@@ -173,6 +220,10 @@ class DocDirExaminer(GObject.GObject):
                 last_mod = datetime.datetime.fromtimestamp(doc.last_mod)
                 if old_infos[1] != last_mod:
                     on_doc_modified(doc)
+                else:
+                    # up-to-date in the index: next time, we won't have to
+                    # look at it
+                    manifest.update(docdir, doc.path)
             else:
                 on_new_doc(doc)
             progress_cb(progress, len(docdirs),
@@ -183,68 +234,206 @@ class DocDirExaminer(GObject.GObject):
         for old_doc in old_doc_list:
             on_doc_deleted(old_doc)
 
+        manifest.save()
         progress_cb(1, 1, DocSearch.INDEX_STEP_CHECKING)
 
 
+def _label_to_term(label):
+    """
+    Labels are stored in the index as terms 'name|color', so the label list
+    can be rebuilt from the index lexicon (see DocSearch.reload_index())
+    """
+    return u"%s|%s" % (label.name, label.get_color_str())
+
+
+def _term_to_label(term):
+    """
+    Reverse of _label_to_term()
+    """
+    (name, color) = term.rsplit(u"|", 1)
+    return Label(name, color)
+
+
+def _get_doc_date(doc):
+    """
+    Scan date of a document, as found in its id
+    """
+    docid = doc.docid
+    try:
+        return datetime.datetime.strptime(
+            docid[:len("YYYYMMDD_hhmm_ss")], BasicDoc.DOCNAME_FORMAT)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime(*doc.date)
+    except ValueError:
+        # the id starts with 8 digits, but they are not a valid date
+        return datetime.datetime(*BasicDoc.DEFAULT_DATE)
+
+
+def _sortable_field(field_type, **kwargs):
+    """
+    Instantiate a field usable to sort the search results. Whoosh >= 2.5
+    can store it as a column, making sorting really cheap. Older versions
+    will use their field cache instead.
+    """
+    try:
+        return field_type(sortable=True, **kwargs)
+    except TypeError:
+        return field_type(**kwargs)
+
+
+def _get_doc_index_fields(doc):
+    """
+    Extract from a document all the fields that must be written in the index
+
+    Returns:
+        (fields for the document index, [fields for the page index, ...])
+    """
+    last_mod = datetime.datetime.fromtimestamp(doc.last_mod)
+    docid = unicode(doc.docid)
+    lines = []
+    pages_fields = []
+    for page in doc.pages:
+        page_lines = [unicode(line) for line in page.text]
+        lines += page_lines
+        page_txt = strip_accents(u"\n".join(page_lines).strip())
+        if page_txt == u"":
+            continue
+        pages_fields.append({
+            'docid': docid,
+            'page_nb': page.page_nb,
+            'content': page_txt,
+        })
+    extra_txt = doc.extra_text
+    if extra_txt != u"":
+        lines.append(extra_txt)
+    label_names = [unicode(label.name) for label in doc.labels]
+    lines.append(u" ".join(label_names))
+    txt = u"\n".join(lines)
+    txt = txt.strip()
+    txt = strip_accents(txt)
+    if txt == u"":
+        # make sure the text field is not empty. Whoosh doesn't like that
+        txt = u"empty"
+    labels = u",".join([strip_accents(name) for name in label_names])
+    label_infos = u",".join([_label_to_term(label) for label in doc.labels])
+
+    doc_fields = {
+        'docid': docid,
+        'doctype': doc.doctype,
+        'content': txt,
+        'label': labels,
+        'label_info': label_infos,
+        'last_read': last_mod,
+        'date': _get_doc_date(doc),
+    }
+    return (doc_fields, pages_fields)
+
+
+def _extract_doc_index_fields(doc_desc):
+    """
+    Instantiate a document and extract its index fields. Used by the worker
+    processes of DocIndexUpdater: documents can't be sent from one process to
+    another, so they are described using a tuple (docpath, docid, doctype).
+    """
+    (docpath, docid, doctype) = doc_desc
+    for (is_doc_type, doc_type_name, doc_type) in DOC_TYPE_LIST:
+        if doc_type_name == doctype:
+            return _get_doc_index_fields(doc_type(docpath, docid))
+    raise ValueError("Unknown doc type for doc %s: %s" % (docid, doctype))
+
+
 class DocIndexUpdater(GObject.GObject):
     """
     Update the index content.
     Don't forget to call commit() to apply the changes
     """
+    # below this number of documents, starting the worker processes costs
+    # more than it saves
+    MIN_DOCS_FOR_PROCESSES = 4
+
     def __init__(self, docsearch, optimize, progress_cb=dummy_progress_cb):
         self.docsearch = docsearch
         self.optimize = optimize
         self.writer = docsearch.index.writer()
+        try:
+            self.page_writer = docsearch.page_index.writer()
+        except Exception:
+            self.writer.cancel()
+            raise
         self.progress_cb = progress_cb
         self.__need_reload = False
+        # manifest changes are only applied once the index changes are
+        # commited
+        self.__manifest_upd = []  # docs
+        self.__manifest_del = []  # docids
 
     @staticmethod
-    def _update_doc_in_index(index_writer, doc):
+    def _write_doc_fields(index_writer, page_writer, fields):
+        """
+        Write in the indexes the fields returned by _get_doc_index_fields()
+        """
+        (doc_fields, pages_fields) = fields
+        index_writer.update_document(**doc_fields)
+        page_writer.delete_by_term("docid", doc_fields['docid'])
+        for page_fields in pages_fields:
+            page_writer.add_document(**page_fields)
+
+    @classmethod
+    def _update_doc_in_index(cls, index_writer, page_writer, doc):
         """
         Add/Update a document in the index
         """
-        last_mod = datetime.datetime.fromtimestamp(doc.last_mod)
-        docid = unicode(doc.docid)
-        txt = u""
-        for page in doc.pages:
-            for line in page.text:
-                txt += unicode(line) + u"\n"
-        extra_txt = doc.extra_text
-        if extra_txt != u"":
-            txt += extra_txt + u"\n"
-        for label in doc.labels:
-            txt += u" " + unicode(label.name)
-        txt = txt.strip()
-        txt = strip_accents(txt)
-        if txt == u"":
-            # make sure the text field is not empty. Whoosh doesn't like that
-            txt = u"empty"
-        labels = u",".join([strip_accents(unicode(label.name))
-                            for label in doc.labels])
-
-        index_writer.update_document(
-            docid=docid,
-            doctype=doc.doctype,
-            content=txt,
-            label=labels,
-            last_read=last_mod
-        )
+        cls._write_doc_fields(index_writer, page_writer,
+                              _get_doc_index_fields(doc))
         return True
 
+    @classmethod
+    def _update_docs_in_index(cls, index_writer, page_writer, docs,
+                              progress_cb=dummy_progress_cb):
+        """
+        Add/Update many documents in the index. Text extraction is done
+        in parallel, in as many processes as there are processors/cores on
+        the computer. The index writer is still fed by the current thread, in
+        the order of the document list.
+        """
+        docs = list(docs)
+        if len(docs) < cls.MIN_DOCS_FOR_PROCESSES:
+            for (progression, doc) in enumerate(docs):
+                progress_cb(progression, len(docs),
+                            DocSearch.INDEX_STEP_INDEXING, doc)
+                cls._update_doc_in_index(index_writer, page_writer, doc)
+            return
+
+        doc_descs = [(doc.path, doc.docid, doc.doctype) for doc in docs]
+        pool = multiprocessing.Pool(multiprocessing.cpu_count())
+        try:
+            all_fields = pool.imap(_extract_doc_index_fields, doc_descs)
+            for (progression, fields) in enumerate(all_fields):
+                progress_cb(progression, len(docs),
+                            DocSearch.INDEX_STEP_INDEXING, docs[progression])
+                cls._write_doc_fields(index_writer, page_writer, fields)
+        finally:
+            pool.terminate()
+            pool.join()
+
     @staticmethod
-    def _delete_doc_from_index(index_writer, docid):
+    def _delete_doc_from_index(index_writer, page_writer, docid):
         """
         Remove a document from the index
         """
         query = whoosh.query.Term("docid", docid)
         index_writer.delete_by_query(query)
+        page_writer.delete_by_query(query)
 
     def add_doc(self, doc):
         """
         Add a document to the index
         """
         print "Indexing new doc: %s" % (str(doc))
-        self._update_doc_in_index(self.writer, doc)
+        self._update_doc_in_index(self.writer, self.page_writer, doc)
+        self.__manifest_upd.append(doc)
         self.__need_reload = True
 
     def upd_doc(self, doc):
@@ -252,14 +441,37 @@ class DocIndexUpdater(GObject.GObject):
         Update a document in the index
         """
         print "Updating modified doc: %s" % (str(doc))
-        self._update_doc_in_index(self.writer, doc)
+        self._update_doc_in_index(self.writer, self.page_writer, doc)
+        self.__manifest_upd.append(doc)
+
+    def add_docs(self, docs, progress_cb=dummy_progress_cb):
+        """
+        Add many documents to the index. Faster than calling add_doc()
+        for each of them.
+        """
+        print "Indexing %d new docs" % (len(docs))
+        self._update_docs_in_index(self.writer, self.page_writer, docs,
+                                   progress_cb)
+        self.__manifest_upd += docs
+        self.__need_reload = True
+
+    def upd_docs(self, docs, progress_cb=dummy_progress_cb):
+        """
+        Update many documents in the index. Faster than calling upd_doc()
+        for each of them.
+        """
+        print "Updating %d modified docs" % (len(docs))
+        self._update_docs_in_index(self.writer, self.page_writer, docs,
+                                   progress_cb)
+        self.__manifest_upd += docs
 
     def del_doc(self, docid):
         """
         Delete a document
         """
         print "Removing doc from the index: %s" % (docid)
-        self._delete_doc_from_index(self.writer, docid)
+        self._delete_doc_from_index(self.writer, self.page_writer, docid)
+        self.__manifest_del.append(docid)
         self.__need_reload = True
 
     def commit(self):
@@ -269,6 +481,18 @@ class DocIndexUpdater(GObject.GObject):
         print "Index: Commiting changes"
         self.writer.commit(optimize=self.optimize)
         del self.writer
+        self.page_writer.commit(optimize=self.optimize)
+        del self.page_writer
+        manifest = self.docsearch.manifest
+        for doc in self.__manifest_upd:
+            manifest.update(doc.docid, doc.path)
+        for docid in self.__manifest_del:
+            manifest.remove(docid)
+        manifest.save()
+        updated = set([doc.docid for doc in self.__manifest_upd])
+        for docid in self.__manifest_del:
+            if not docid in updated:
+                THUMBNAIL_CACHE.remove_doc(docid)
         self.docsearch.reload_searcher()
         if self.__need_reload:
             print "Index: Reloading ..."
@@ -281,6 +505,120 @@ class DocIndexUpdater(GObject.GObject):
         print "Index: Index update cancelled"
         self.writer.cancel()
         del self.writer
+        self.page_writer.cancel()
+        del self.page_writer
+
+
+class DocIndexWriter(object):
+    """
+    Long-lived writer owned by DocSearch. Index changes are queued instead of
+    being applied immediately. Successive changes on a same document are
+    coalesced (only the last one matters), and they are all commited at once
+    when there are too many of them pending, or when the oldest of them has
+    been waiting for too long.
+
+    Searchers only see the changes once they are commited.
+    """
+    OP_UPDATE = "update"
+    OP_DELETE = "delete"
+
+    MAX_PENDING = 50  # documents
+    MAX_DELAY = 5.0  # seconds
+
+    def __init__(self, docsearch):
+        self.docsearch = docsearch
+        # also prevents queuing changes while a flush is in progress
+        self.__lock = threading.RLock()
+        self.__pending = collections.OrderedDict()  # docid --> (op, doc/docid)
+        self.__timer = None
+
+    def __queue(self, docid, operation, obj):
+        with self.__lock:
+            # keep the order of the last changes
+            self.__pending.pop(docid, None)
+            self.__pending[docid] = (operation, obj)
+            if len(self.__pending) >= self.MAX_PENDING:
+                self.flush()
+            elif self.__timer is None:
+                self.__timer = threading.Timer(self.MAX_DELAY, self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def upd_doc(self, doc):
+        """
+        Queue the addition or the update of a document
+        """
+        self.__queue(doc.docid, self.OP_UPDATE, doc)
+
+    def del_doc(self, docid):
+        """
+        Queue the removal of a document
+        """
+        self.__queue(docid, self.OP_DELETE, docid)
+
+    def __cancel_timer(self):
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+
+    def flush(self):
+        """
+        Commit immediately all the pending changes
+        """
+        with self.__lock:
+            self.__cancel_timer()
+            if len(self.__pending) <= 0:
+                return
+            pending = self.__pending
+            self.__pending = collections.OrderedDict()
+
+            try:
+                updater = DocIndexUpdater(self.docsearch, optimize=False)
+            except whoosh.index.LockError, exc:
+                # another updater is currently running --> retry later
+                print ("Index: Unable to commit the %d pending changes now: %s"
+                       % (len(pending), str(exc)))
+                self.__pending = pending
+                self.__timer = threading.Timer(self.MAX_DELAY, self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+                return
+            except Exception, exc:
+                print ("Index: Unable to commit the %d pending changes: %s"
+                       % (len(pending), str(exc)))
+                return
+
+            # We may be in the timer thread: nobody would catch an
+            # exception. Documents are handled one by one, so a problem with
+            # one of them doesn't make us lose the changes on the others.
+            print "Index: Commiting %d pending changes" % len(pending)
+            for (docid, (operation, obj)) in pending.items():
+                if (operation == self.OP_UPDATE
+                        and not os.path.exists(obj.path)):
+                    # deleted or renamed while its change was pending
+                    print ("Index: Document %s has disappeared" % docid)
+                    (operation, obj) = (self.OP_DELETE, docid)
+                try:
+                    if operation == self.OP_UPDATE:
+                        updater.upd_doc(obj)
+                    else:
+                        updater.del_doc(obj)
+                except Exception, exc:
+                    print ("Index: Unable to apply the pending change on"
+                           " document %s: %s" % (docid, str(exc)))
+            try:
+                updater.commit()
+            except Exception, exc:
+                print ("Index: Unable to commit the %d pending changes: %s"
+                       % (len(pending), str(exc)))
+
+    def cancel(self):
+        """
+        Forget about all the pending changes
+        """
+        with self.__lock:
+            self.__cancel_timer()
+            self.__pending = collections.OrderedDict()
 
 
 def is_dir_empty(dirpath):
@@ -292,6 +630,42 @@ def is_dir_empty(dirpath):
     return (len(os.listdir(dirpath)) <= 0)
 
 
+class DocSearchResults(object):
+    """
+    Documents matching a search (see DocSearch.find_documents_paged()).
+    The first ones are available immediately ('docs'). The others are only
+    looked for when iterating on remaining().
+    """
+
+    def __init__(self, get_doc, first_docids, total, get_all_docids):
+        """
+        Arguments:
+            get_doc --- callback: docid --> doc (or None if it doesn't exist)
+            first_docids --- docids of the first results
+            total --- total number of results. Documents that have
+                disappeared are counted as well, so it's an estimation.
+            get_all_docids --- callback returning the docids of all the
+                results
+        """
+        self.__get_doc = get_doc
+        self.__get_all_docids = get_all_docids
+        self.__nb_first = len(first_docids)
+        self.total = total
+        self.docs = [doc for doc in (get_doc(docid) for docid in first_docids)
+                     if doc is not None]
+
+    def remaining(self):
+        """
+        Yield the documents following those in 'docs'. The search is only
+        done once the first of them is requested.
+        """
+        docids = self.__get_all_docids()
+        for docid in docids[self.__nb_first:]:
+            doc = self.__get_doc(docid)
+            if doc is not None:
+                yield doc
+
+
 class DocSearch(object):
     """
     Index a set of documents. Can provide:
@@ -304,10 +678,28 @@ class DocSearch(object):
     INDEX_STEP_CLEANING = "cleaning"
     INDEX_STEP_CHECKING = "checking"
     INDEX_STEP_READING = "checking"
+    INDEX_STEP_INDEXING = "indexing"
     INDEX_STEP_COMMIT = "commit"
     LABEL_STEP_UPDATING = "label updating"
     LABEL_STEP_DESTROYING = "label deletion"
-    OCR_THREADS_POLLING_TIME = 0.5
+    PAGE_INDEX = "pages"
+    SORT_BY_RELEVANCE = "relevance"
+    SORT_BY_DATE = "date"  # most recent first
+    # sort key --> arguments for whoosh.searching.Searcher.search()
+    __SORTINGS = {
+        SORT_BY_RELEVANCE: {},
+        SORT_BY_DATE: {'sortedby': ['date', 'docid'], 'reverse': True},
+    }
+    QUERY_CACHE_SIZE = 128
+    RESULT_CACHE_SIZE = 32
+    RESULT_PAGE_LEN = 50
+    # as-you-type searches: the last word is looked for as a prefix
+    MIN_PREFIX_LEN = 2
+    # characters and words meaningful for the query parser. Sentences
+    # containing them can't be searched as-you-type
+    QUERY_SYNTAX_REGEX = re.compile(
+        r"""["'()\[\]{}:*?~^]|\b(AND|OR|NOT|ANDNOT|ANDMAYBE|TO)\b""",
+        re.UNICODE)
 
     def __init__(self, rootdir, callback=dummy_progress_cb):
         """
@@ -327,35 +719,89 @@ class DocSearch(object):
                                   os.path.expanduser("~/.local/share"))
         self.indexdir = os.path.join(base_indexdir, "paperwork", "index")
         mkdir_p(self.indexdir)
+        self.manifest = DocDirManifest(self.indexdir)
 
-        self.__docs_by_id = {}  # docid --> doc
+        # Documents are only instantiated when they are first accessed
+        self.__doctypes_by_id = {}  # docid --> doctype, for all the docs
+        self.__docs_by_id = {}  # docid --> doc, for the instantiated docs
         self.label_list = []
 
-        try:
-            print ("Opening index dir '%s' ..." % self.indexdir)
-            self.index = whoosh.index.open_dir(self.indexdir)
-        except whoosh.index.EmptyIndexError, exc:
-            print ("Failed to open index '%s'" % self.indexdir)
-            print ("Exception was: %s" % str(exc))
-            print ("Will try to create a new one")
-            schema = whoosh.fields.Schema(
-                docid=whoosh.fields.ID(stored=True, unique=True),
-                doctype=whoosh.fields.ID(stored=True, unique=False),
-                content=whoosh.fields.TEXT(spelling=True),
-                label=whoosh.fields.KEYWORD(stored=True, commas=True,
-                                            spelling=True, scorable=True),
-                last_read=whoosh.fields.DATETIME(stored=True),
-            )
+        schema = whoosh.fields.Schema(
+            docid=_sortable_field(whoosh.fields.ID, stored=True, unique=True),
+            doctype=whoosh.fields.ID(stored=True, unique=False),
+            content=whoosh.fields.TEXT(spelling=True),
+            label=whoosh.fields.KEYWORD(stored=True, commas=True,
+                                        spelling=True, scorable=True),
+            label_info=whoosh.fields.KEYWORD(commas=True),
+            last_read=whoosh.fields.DATETIME(stored=True),
+            date=_sortable_field(whoosh.fields.DATETIME),
+        )
+        # one entry per page having some text. Tells which pages of a
+        # document match a search
+        page_schema = whoosh.fields.Schema(
+            docid=whoosh.fields.ID(stored=True),
+            page_nb=whoosh.fields.NUMERIC(stored=True),
+            content=whoosh.fields.TEXT(),
+        )
+
+        (self.index, created) = self.__open_index(schema, None)
+        (self.page_index, page_created) = self.__open_index(page_schema,
+                                                            self.PAGE_INDEX)
+        if page_created and not created:
+            # the page index can only be filled by reindexing all the
+            # documents
+            print ("Page index is new. Will rebuild the document index")
             self.index = whoosh.index.create_in(self.indexdir, schema)
-            print ("Index '%s' created" % self.indexdir)
 
         self.__qparser = whoosh.qparser.QueryParser("content",
                                                     self.index.schema)
         self.__searcher = self.index.searcher()
+        self.__page_searcher = self.page_index.searcher()
+        self.__index_writer = DocIndexWriter(self)
+
+        # Incremented each time the index content may have changed. Search
+        # results are cached per generation.
+        self.__generation = 0
+        self.__query_cache = LRUCache(self.QUERY_CACHE_SIZE)  # sentence --> q
+        # (generation, sentence) --> docids
+        self.__result_cache = LRUCache(self.RESULT_CACHE_SIZE)
+        # last as-you-type search that can be narrowed:
+        # (generation, sentence, docnums)
+        self.__last_typed = None
         # TODO(Jflesch): Too dangerous
         #self.cleanup_rootdir(callback)
         self.reload_index(callback)
 
+    def __open_index(self, schema, indexname):
+        """
+        Open an index from the index directory. If it doesn't exist or if it
+        has been made by an older version of Paperwork, create a new one.
+
+        Returns:
+            (index, True if it has just been created)
+        """
+        if indexname is None:
+            index_desc = self.indexdir
+        else:
+            index_desc = "%s (%s)" % (self.indexdir, indexname)
+        try:
+            print ("Opening index '%s' ..." % index_desc)
+            index = whoosh.index.open_dir(self.indexdir, indexname=indexname)
+            if index.schema.names() == schema.names():
+                return (index, False)
+            print ("Index '%s' has been made by an older version of"
+                   " Paperwork" % index_desc)
+            print ("Will rebuild it")
+            index.close()
+        except whoosh.index.EmptyIndexError, exc:
+            print ("Failed to open index '%s'" % index_desc)
+            print ("Exception was: %s" % str(exc))
+            print ("Will try to create a new one")
+        index = whoosh.index.create_in(self.indexdir, schema,
+                                       indexname=indexname)
+        print ("Index '%s' created" % index_desc)
+        return (index, True)
+
     @staticmethod
     def __browse_dir(rootdir):
         """
@@ -404,9 +850,18 @@ class DocSearch(object):
         made to modify the documents themselves.
         Some helper methods, with more specific goals, may be available for
         what you want to do.
+
+        Changes queued by index_page() are commited first.
         """
+        self.__index_writer.flush()
         return DocIndexUpdater(self, optimize)
 
+    def flush_index(self):
+        """
+        Commit immediately the changes queued by index_page()
+        """
+        self.__index_writer.flush()
+
     def __inst_doc_from_id(self, docid, doc_type_name=None):
         """
         Instantiate a document based on its document id.
@@ -435,42 +890,69 @@ class DocSearch(object):
         """
         if docid in self.__docs_by_id:
             return self.__docs_by_id[docid]
+        if doc_type_name is None:
+            doc_type_name = self.__doctypes_by_id.get(docid)
         self.__docs_by_id[docid] = self.__inst_doc_from_id(docid,
                                                            doc_type_name)
         return self.__docs_by_id[docid]
 
+    def __get_indexed_doc(self, docid):
+        """
+        Return the document corresponding to the given docid, if it is in the
+        index. It is instantiated if required.
+        """
+        if docid in self.__docs_by_id:
+            return self.__docs_by_id[docid]
+        doctype = self.__doctypes_by_id.get(docid)
+        if doctype is None:
+            return None
+        doc = self.__inst_doc_from_id(docid, doctype)
+        if doc is None:
+            print "Warning: document '%s' has disappeared" % docid
+            self.__doctypes_by_id.pop(docid, None)
+            return None
+        self.__docs_by_id[docid] = doc
+        return doc
+
     def reload_index(self, progress_cb=dummy_progress_cb):
         """
-        Read the index, and load the document list from it
+        Read the index, and load the document list from it.
+
+        Only the fields stored in the index are read: documents are not
+        instantiated here (see __get_indexed_doc()), and the label list comes
+        from the index lexicon.
         """
         docs_by_id = self.__docs_by_id
         self.__docs_by_id = {}
         for doc in docs_by_id.values():
-            doc.drop_cache()
+            if doc is not None:
+                doc.drop_cache()
         del docs_by_id
 
         query = whoosh.query.Every()
         results = self.__searcher.search(query, limit=None)
 
         nb_results = len(results)
-        progress = 0
-        labels = set()
+        doctypes_by_id = {}
+        for (progress, result) in enumerate(results):
+            progress_cb(progress, nb_results, self.INDEX_STEP_LOADING)
+            doctypes_by_id[result['docid']] = result['doctype']
+        self.__doctypes_by_id = doctypes_by_id
 
-        for result in results:
-            docid = result['docid']
-            doctype = result['doctype']
-            doc = self.__inst_doc_from_id(docid, doctype)
-            if doc is None:
+        labels = set()
+        for term in self.__searcher.reader().lexicon("label_info"):
+            if not isinstance(term, unicode):
+                term = term.decode('utf-8')
+            # the lexicon may still contain the labels of deleted documents
+            query = whoosh.query.Term("label_info", term)
+            if self.__searcher.search(query, limit=1).is_empty():
                 continue
-            progress_cb(progress, nb_results, self.INDEX_STEP_LOADING, doc)
-            self.__docs_by_id[docid] = doc
-            for label in doc.labels:
-                labels.add(label)
-            progress += 1
+            labels.add(_term_to_label(term))
         progress_cb(1, 1, self.INDEX_STEP_LOADING)
 
         self.label_list = [label for label in labels]
         self.label_list.sort()
+        self.__new_generation()
 
     def index_page(self, page):
         """
@@ -479,69 +961,270 @@ class DocSearch(object):
         Arguments:
             page --- from which keywords must be extracted
 
-        Obsolete. To remove. Use get_index_updater() instead
+        The change is queued: the index is updated a little bit later, along
+        with the changes made to other pages. Use flush_index() to apply it
+        immediately.
         """
-        updater = self.get_index_updater(optimize=False)
-        updater.upd_doc(page.doc)
-        updater.commit()
-        if not page.doc.docid in self.__docs_by_id:
+        self.__index_writer.upd_doc(page.doc)
+        if not page.doc.docid in self.__doctypes_by_id:
             print ("Adding document '%s' to the index" % page.doc.docid)
+            self.__doctypes_by_id[page.doc.docid] = page.doc.doctype
             self.__docs_by_id[page.doc.docid] = page.doc
 
-    def __find_documents(self, query):
+    def unindex_doc(self, docid):
         """
-        Find a list of documents based on a whoosh query
+        Remove a document from the index. Use it when a document is deleted.
+
+        The change is queued, like the ones made by index_page().
         """
-        docs = []
-        results = self.__searcher.search(query, limit=None)
+        self.__index_writer.del_doc(docid)
+        self.__doctypes_by_id.pop(docid, None)
+        self.__docs_by_id.pop(docid, None)
+
+    def __parse_query(self, sentence):
+        """
+        Turn a normalized sentence into a whoosh query
+        """
+        query = self.__query_cache.get(sentence)
+        if query is None:
+            query = self.__qparser.parse(sentence)
+            self.__query_cache[sentence] = query
+        return query
+
+    @staticmethod
+    def __normalize_sentence(sentence, as_you_type):
+        """
+        Strip the accents and the useless spaces. For as-you-type searches,
+        a trailing space is kept: it indicates that the last word is complete.
+        """
+        sentence = strip_accents(sentence)
+        normalized = u" ".join(sentence.split())
+        if as_you_type and normalized != u"" and sentence[-1:].isspace():
+            normalized += u" "
+        return normalized
+
+    def __get_as_you_type_query(self, sentence):
+        """
+        Build the query for an as-you-type search: complete words must match
+        exactly, the last one (if not complete) is looked for as a prefix.
+
+        Returns:
+            (query, narrowable). If narrowable is True, the documents matching
+            this query are a subset of the documents matching any
+            narrowable query of a sentence it starts with. If there is
+            nothing to look for (only stop words, or words too short), the
+            query matches no document.
+        """
+        if self.QUERY_SYNTAX_REGEX.search(sentence):
+            return (self.__parse_query(sentence.strip()), False)
+
+        content_field = self.index.schema['content']
+        words = sentence.split(u" ")
+        last_word = words.pop()
+        terms = list(content_field.process_text(u" ".join(words),
+                                                mode="query"))
+        prefixes = list(content_field.process_text(last_word, mode="query",
+                                                   removestops=False))
+        # the query must reflect exactly what has been typed, otherwise
+        # narrowing previous results could lose some documents
+        narrowable = (terms == [word.lower() for word in words]
+                      and (last_word == u""
+                           or prefixes == [last_word.lower()]))
+
+        queries = [whoosh.query.Term("content", term) for term in terms]
+        if len(prefixes) > 0:
+            queries += [whoosh.query.Term("content", term)
+                        for term in prefixes[:-1]]
+            if len(prefixes[-1]) >= self.MIN_PREFIX_LEN:
+                queries.append(whoosh.query.Prefix("content", prefixes[-1]))
+        if len(queries) <= 0:
+            # only stop words or too short words: nothing to look for (and
+            # certainly not every document)
+            return (whoosh.query.NullQuery, False)
+        return (whoosh.query.And(queries), narrowable)
+
+    def __get_query(self, sentence, as_you_type):
+        """
+        Returns:
+            (query, narrowable) --- see __get_as_you_type_query()
+        """
+        if as_you_type:
+            return self.__get_as_you_type_query(sentence)
+        return (self.__parse_query(sentence), False)
+
+    def __find_docids(self, generation, searcher, sentence, as_you_type,
+                      sort):
+        """
+        Find the ids of all the documents matching a normalized sentence
+        """
+        key = (generation, sentence, as_you_type, sort)
+        docids = self.__result_cache.get(key)
+        if docids is not None:
+            return docids
+
+        (query, narrowable) = self.__get_query(sentence, as_you_type)
+        search_filter = None
+        last_typed = self.__last_typed
+        if (narrowable and last_typed is not None
+                and last_typed[0] == generation
+                and sentence.startswith(last_typed[1])):
+            # characters have been appended to the previous sentence: only
+            # the documents previously found can match
+            search_filter = last_typed[2]
+        results = searcher.search(query, limit=None, filter=search_filter,
+                                  **self.__SORTINGS[sort])
         docids = [result['docid'] for result in results]
-        docs = [self.__docs_by_id.get(docid) for docid in docids]
-        try:
-            while True:
-                docs.remove(None)
-        except ValueError:
-            pass
-        assert (not None in docs)
-        return docs
+        if narrowable:
+            self.__last_typed = (generation, sentence, results.docs())
+        self.__result_cache[key] = docids
+        return docids
+
+    def __find_documents(self, sentence, as_you_type, sort):
+        """
+        Find a list of documents based on a normalized sentence
+        """
+        # the generation must be read before the searcher (see
+        # reload_searcher())
+        generation = self.__generation
+        searcher = self.__searcher
+        docids = self.__find_docids(generation, searcher, sentence,
+                                    as_you_type, sort)
+        docs = [self.__get_indexed_doc(docid) for docid in docids]
+        return [doc for doc in docs if doc is not None]
+
+    def __get_all_docids(self, sort):
+        """
+        Return the ids of all the documents, including those not commited yet
+        in the index
+        """
+        docids = self.__doctypes_by_id.keys()
+        if sort == self.SORT_BY_DATE:
+            # docids start with the scan date
+            docids.sort(reverse=True)
+        return docids
 
     def __get_all_docs(self):
         """
         Return all the documents. Beware, they are unsorted.
         """
-        return self.__docs_by_id.values()
+        docs = [self.__get_indexed_doc(docid)
+                for docid in self.__doctypes_by_id.keys()]
+        return [doc for doc in docs if doc is not None]
 
     docs = property(__get_all_docs)
 
     def get_by_id(self, obj_id):
         """
         Get a document or a page using its ID
-        Won't instantiate them if they are not yet available
+        Documents known from the index are instantiated if required
         """
+        page_nb = None
+        docid = obj_id
         if "/" in obj_id:
             (docid, page_nb) = obj_id.split("/")
             page_nb = int(page_nb)
-            return self.__docs_by_id[docid].pages[page_nb]
-        return self.__docs_by_id[obj_id]
-
-    def find_documents(self, sentence):
+        doc = self.__get_indexed_doc(docid)
+        if doc is None:
+            raise KeyError(obj_id)
+        if page_nb is not None:
+            return doc.pages[page_nb]
+        return doc
+
+    def find_documents(self, sentence, as_you_type=False,
+                       sort=SORT_BY_RELEVANCE):
         """
         Returns all the documents matching the given keywords
 
         Arguments:
             keywords --- keywords (single string)
+            as_you_type --- True if the sentence is being typed by the user:
+                the last word may not be complete yet, and the results of the
+                previous search are narrowed when possible.
+            sort --- DocSearch.SORT_BY_RELEVANCE or DocSearch.SORT_BY_DATE.
+                Results are sorted by Whoosh directly. If the sentence is
+                empty, sorting by relevance means no sorting at all.
 
         Returns:
             An array of document id (strings)
         """
-        sentence = sentence.strip()
+        sentence = self.__normalize_sentence(sentence, as_you_type)
 
         if sentence == u"":
-            return self.docs
+            docs = [self.__get_indexed_doc(docid)
+                    for docid in self.__get_all_docids(sort)]
+            return [doc for doc in docs if doc is not None]
 
-        sentence = strip_accents(sentence)
+        return self.__find_documents(sentence, as_you_type, sort)
+
+    def find_documents_paged(self, sentence, page_len=RESULT_PAGE_LEN,
+                             as_you_type=False, sort=SORT_BY_RELEVANCE):
+        """
+        Search the documents matching the given keywords, but only get the
+        first of them immediately. Useful to display quickly the first
+        results of broad searches.
 
-        query = self.__qparser.parse(sentence)
-        return self.__find_documents(query)
+        Arguments:
+            sentence --- keywords (single string)
+            page_len --- number of documents to get immediately
+            as_you_type --- see find_documents()
+            sort --- see find_documents()
+
+        Returns:
+            A DocSearchResults object
+        """
+        sentence = self.__normalize_sentence(sentence, as_you_type)
+
+        if sentence == u"":
+            docids = self.__get_all_docids(sort)
+            return DocSearchResults(self.__get_indexed_doc, docids[:page_len],
+                                    len(docids), lambda: docids)
+
+        # the generation must be read before the searcher (see
+        # reload_searcher())
+        generation = self.__generation
+        searcher = self.__searcher
+        get_all_docids = (lambda: self.__find_docids(generation, searcher,
+                                                     sentence, as_you_type,
+                                                     sort))
+
+        docids = self.__result_cache.get((generation, sentence, as_you_type,
+                                          sort))
+        if docids is not None:
+            return DocSearchResults(self.__get_indexed_doc, docids[:page_len],
+                                    len(docids), get_all_docids)
+
+        query = self.__get_query(sentence, as_you_type)[0]
+        page = searcher.search_page(query, 1, pagelen=page_len,
+                                    **self.__SORTINGS[sort])
+        return DocSearchResults(self.__get_indexed_doc,
+                                [hit['docid'] for hit in page], page.total,
+                                get_all_docids)
+
+    def find_pages(self, sentence, docid=None, as_you_type=False):
+        """
+        Find the pages matching the given keywords. Only the text of the
+        pages is taken into account (not the labels of the documents for
+        instance).
+
+        Arguments:
+            sentence --- keywords (single string)
+            docid --- if not None, only look for pages of this document
+            as_you_type --- see find_documents()
+
+        Returns:
+            An array of (docid, page number), sorted
+        """
+        sentence = self.__normalize_sentence(sentence, as_you_type)
+        if sentence == u"":
+            return []
+        query = self.__get_query(sentence, as_you_type)[0]
+        if docid is not None:
+            query = whoosh.query.And([whoosh.query.Term("docid", docid),
+                                      query])
+        results = self.__page_searcher.search(query, limit=None)
+        pages = [(result['docid'], result['page_nb']) for result in results]
+        pages.sort()
+        return pages
 
     def find_suggestions(self, sentence):
         """
@@ -553,10 +1236,11 @@ class DocSearch(object):
                 suggestions
         Return:
             An array of sets of keywords. Each set of keywords (-> one string)
-            is a suggestion.
+            is a suggestion. The suggestions whose new keyword appears in the
+            most documents come first.
         """
         keywords = sentence.split(" ")
-        final_suggestions = []
+        final_suggestions = []  # (doc frequency, suggestion)
 
         corrector = self.__searcher.corrector("content")
         for keyword_idx in range(0, len(keywords)):
@@ -565,14 +1249,22 @@ class DocSearch(object):
                 continue
             keyword_suggestions = corrector.suggest(keyword, limit=5)[:]
             for keyword_suggestion in keyword_suggestions:
+                frequency = self.__searcher.doc_frequency("content",
+                                                          keyword_suggestion)
+                if frequency <= 0:
+                    continue
                 new_suggestion = keywords[:]
                 new_suggestion[keyword_idx] = keyword_suggestion
                 new_suggestion = u" ".join(new_suggestion)
-                if len(self.find_documents(new_suggestion)) <= 0:
+                # we just need to know if at least one document matches
+                query = self.__parse_query(
+                    u" ".join(strip_accents(new_suggestion).split()))
+                if self.__searcher.search(query, limit=1).is_empty():
                     continue
-                final_suggestions.append(new_suggestion)
-        final_suggestions.sort()
-        return final_suggestions
+                final_suggestions.append((frequency, new_suggestion))
+        final_suggestions.sort(key=lambda (frequency, suggestion):
+                               (-frequency, suggestion))
+        return [suggestion for (frequency, suggestion) in final_suggestions]
 
     def add_label(self, doc, label):
         """
@@ -648,8 +1340,20 @@ class DocSearch(object):
         You shouldn't have to call this method yourself.
         """
         searcher = self.__searcher
+        page_searcher = self.__page_searcher
         self.__searcher = self.index.searcher()
+        self.__page_searcher = self.page_index.searcher()
+        self.__new_generation()
         del(searcher)
+        del(page_searcher)
+
+    def __new_generation(self):
+        """
+        Invalidate the search results computed until now
+        """
+        self.__generation += 1
+        self.__result_cache.clear()
+        self.__last_typed = None
 
     def redo_ocr(self, langs, progress_callback=dummy_progress_cb):
         """
@@ -658,34 +1362,25 @@ class DocSearch(object):
 
         Arguments:
             progress_callback --- See util.dummy_progress_cb for a
-                prototype. The only step returned is "INDEX_STEP_READING"
+                prototype. The only step returned is "INDEX_STEP_READING".
+                It may raise an exception to interrupt the process (see
+                OcrExecutor.redo_ocr()).
             langs --- Languages to use with the spell checker and the OCR tool
                 ( { 'ocr' : 'fra', 'spelling' : 'fr' } )
         """
         print "Redoing OCR of all documents ..."
 
-        dlist = self.docs
-        threads = []
-        remaining = dlist[:]
-
-        max_threads = multiprocessing.cpu_count()
+        pages = []
+        for doc in self.docs:
+            if not doc.can_edit:
+                continue
+            pages += [(doc, page_nb) for page_nb in range(0, doc.nb_pages)]
 
-        while (len(remaining) > 0 or len(threads) > 0):
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-            while (len(threads) < max_threads and len(remaining) > 0):
-                doc = remaining.pop()
-                if not doc.can_edit:
-                    continue
-                thread = threading.Thread(target=doc.redo_ocr,
-                                          args=[langs], name=doc.docid)
-                thread.start()
-                threads.append(thread)
-                progress_callback(len(dlist) - len(remaining),
-                                  len(dlist), self.INDEX_STEP_READING,
-                                  doc)
-            time.sleep(self.OCR_THREADS_POLLING_TIME)
+        OCR_EXECUTOR.redo_ocr(
+            pages, langs,
+            lambda progression, total, doc:
+            progress_callback(progression, total, self.INDEX_STEP_READING,
+                              doc))
         print "OCR of all documents done"
 
     def destroy_index(self):
@@ -694,5 +1389,6 @@ class DocSearch(object):
         call. Next instantiation of a DocSearch will rebuild the whole index
         """
         print "Destroying the index ..."
+        self.__index_writer.cancel()
         rm_rf(self.indexdir)
         print "Done"
@@ -110,10 +110,12 @@ class ImgToPdfDocExporter(object):
         pdfpage = pdfdoc.get_page(0)
         pdfpage_size = pdfpage.get_size()
 
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24,
                                      int(pdfpage_size[0]),
                                      int(pdfpage_size[1]))
         ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
+        ctx.paint()
         pdfpage.render(ctx)
         img = surface2image(surface)
 
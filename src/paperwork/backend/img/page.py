@@ -19,92 +19,26 @@
 Code relative to page handling.
 """
 
-import codecs
 from copy import copy
 import Image
-import multiprocessing
+import ImageStat
 import os
 import os.path
-import re
-import threading
-import time
 
 from gi.repository import Gtk
-import pyocr.builders
 import pyocr.pyocr
 
+from paperwork.backend.common import boxcache
 from paperwork.backend.common.page import BasicPage
 from paperwork.backend.common.page import PageExporter
 from paperwork.backend.config import PaperworkConfig
-from paperwork.util import check_spelling
+from paperwork.backend.ocr import as_completed
+from paperwork.backend.ocr import OCR_EXECUTOR
+from paperwork.util import boxes_to_text
 from paperwork.util import dummy_progress_cb
 from paperwork.util import image2surface
 
 
-class ImgOCRThread(threading.Thread):
-    def __init__(self, ocr_tool, langs, imgpath, compute_score=True):
-        threading.Thread.__init__(self, name="OCR")
-        self.ocr_tool = ocr_tool
-        self.langs = langs
-        self.imgpath = imgpath
-        self.compute_score = compute_score
-        self.score = -1
-        self.text = None
-
-    def __compute_ocr_score_with_spell_checking(self, txt):
-        return check_spelling(self.langs['spelling'], txt)
-
-    @staticmethod
-    def __compute_ocr_score_without_spell_checking(txt):
-        """
-        Try to evaluate how well the OCR worked.
-        Current implementation:
-            The score is the number of words only made of 4 or more letters
-            ([a-zA-Z])
-        """
-        # TODO(Jflesch): i18n / l10n
-        score = 0
-        prog = re.compile(r'^[a-zA-Z]{4,}$')
-        for word in txt.split(" "):
-            if prog.match(word):
-                score += 1
-        return (txt, score)
-
-    def run(self):
-        SCORE_METHODS = [
-            ("spell_checker", self.__compute_ocr_score_with_spell_checking),
-            ("lucky_guess", self.__compute_ocr_score_without_spell_checking),
-            ("no_score", lambda txt: (txt, 0))
-        ]
-
-        img = Image.open(self.imgpath)
-
-        print ("Running OCR on '%s'" % self.imgpath)
-        self.text = self.ocr_tool.image_to_string(img, lang=self.langs['ocr'])
-
-        if not self.compute_score:
-            self.score = 0
-            return
-
-        for score_method in SCORE_METHODS:
-            try:
-                print ("Evaluating score of this page orientation (%s)"
-                       " using method '%s' ..."
-                       % (self.imgpath, score_method[0]))
-                (fixed_text, self.score) = score_method[1](self.text)
-                # TODO(Jflesch): For now, we throw away the fixed version:
-                # The original version may contain proper nouns, and spell
-                # checking could make them disappear
-                # However, it would be best if we could keep both versions
-                # without increasing too much indexation time
-                print "Page orientation score: %d" % self.score
-                return
-            except Exception, exc:
-                print ("**WARNING** Scoring method '%s' failed !"
-                       % score_method[0])
-                print ("Reason: %s" % (str(exc)))
-
-
 class ImgPage(BasicPage):
     """
     Represents a page. A page is a sub-element of ImgDoc.
@@ -116,16 +50,27 @@ class ImgPage(BasicPage):
     EXT_IMG_SCAN = "bmp"
     EXT_IMG = "jpg"
     EXT_THUMB = "thumb.jpg"
+    EXT_WORD_MAP = "wordmap"
+    EXT_BOX_CACHE = "boxes"
 
     KEYWORD_HIGHLIGHT = 3
 
     ORIENTATION_PORTRAIT = 0
     ORIENTATION_LANDSCAPE = 1
 
-    OCR_THREADS_POLLING_TIME = 0.1
+    # rotation (number of quarter turns clockwise) --> PIL transposition
+    ROTATIONS = [
+        None,
+        Image.ROTATE_270,
+        Image.ROTATE_180,
+        Image.ROTATE_90,
+    ]
+    # max width or height of the sample used to find the page orientation
+    ORIENTATION_SAMPLE_MAX_SIZE = 1024
 
     def __init__(self, doc, page_nb):
         BasicPage.__init__(self, doc, page_nb)
+        self.__boxes = None
 
     def __get_filepath(self, ext):
         """
@@ -153,11 +98,27 @@ class ImgPage(BasicPage):
 
     def __get_thumb_path(self):
         """
-        Returns the file path of the thumbnail corresponding to this page
+        Returns the file path of the thumbnail corresponding to this page.
+        Thumbnails are now kept in the thumbnail cache (see
+        backend.common.thumbnail), but older documents may still have one.
         """
         return self.__get_filepath(self.EXT_THUMB)
 
-    __thumb_path = property(__get_thumb_path)
+    def __get_word_map_path(self):
+        """
+        Returns the file path of the word map (see BasicPage.get_boxes())
+        """
+        return self.__get_filepath(self.EXT_WORD_MAP)
+
+    def __get_box_cache_path(self):
+        """
+        Returns the file path of the binary cache of the box list (see
+        backend.common.boxcache)
+        """
+        return self.__get_filepath(self.EXT_BOX_CACHE)
+
+    def _get_word_map_paths(self):
+        return (self.__get_word_map_path(), self.__get_box_path())
 
     def __get_last_mod(self):
         try:
@@ -181,20 +142,22 @@ class ImgPage(BasicPage):
         """
         Get all the word boxes of this page.
         """
-        boxfile = self.__box_path
-
-        box_builder = pyocr.builders.LineBoxBuilder()
-
+        if self.__boxes is not None:
+            return self.__boxes
         try:
-            with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
-                boxes = box_builder.read_file(file_desc)
-            return boxes
-        except IOError, exc:
+            self.__boxes = boxcache.read_boxes(self.__box_path,
+                                               self.__get_box_cache_path())
+        except (IOError, OSError), exc:
             print "Unable to get boxes for '%s': %s" % (self.doc.docid, exc)
             return []
+        return self.__boxes
 
     boxes = property(__get_boxes)
 
+    def drop_cache(self):
+        BasicPage.drop_cache(self)
+        self.__boxes = None
+
     def __get_img(self):
         """
         Returns an image object corresponding to the page
@@ -207,45 +170,26 @@ class ImgPage(BasicPage):
 
     img = property(__get_img, __set_img)
 
-    def __make_thumbnail(self, width):
+    def _get_thumbnail_src_path(self):
+        return self.__img_path
+
+    def _get_thumbnail(self, width):
         """
-        Create the page's thumbnail
+        Generate a thumbnail of the page. Thanks to Image.draft(), the JPEG
+        decoder directly gives us a reduced version of the image, close to
+        the wanted size, instead of the full-resolution one.
         """
-        img = self.img
+        img = Image.open(self.__img_path)
         (w, h) = img.size
-        factor = (float(w) / width)
-        w = width
-        h /= factor
-        img = img.resize((int(w), int(h)), Image.ANTIALIAS)
-        img.save(self.__thumb_path)
+        height = max(1, int(h * width / w))
+        img.draft('RGB', (width, height))
+        img = img.resize((width, height), Image.ANTIALIAS)
         return img
 
-    def __get_thumbnail(self):
+    def __prepare_img(self, img, scan_res=0, scanner_calibration=None):
         """
-        Returns an image object corresponding to the last saved thumbnail
-        """
-        return Image.open(self.__thumb_path)
-
-    def _get_thumbnail(self, width):
-        """
-        Returns an image object corresponding to the up-to-date thumbnail
-        """
-        try:
-            if os.path.getmtime(self.__img_path) > \
-               os.path.getmtime(self.__thumb_path):
-                return self.__make_thumbnail(width)
-            else:
-                return self.__get_thumbnail()
-        except:
-            return self.__make_thumbnail(width)
-
-    def __save_imgs(self, img, scan_res=0, scanner_calibration=None,
-                    callback=dummy_progress_cb):
-        """
-        Make a page (on disk), and generate 4 output files:
-            <docid>/paper.rotated.0.bmp: original output
-            <docid>/paper.rotated.1.bmp: original output at 90 degrees
-        OCR will have to decide which is the best
+        Crop the scan according to the scanner calibration, and strip its
+        alpha channel
         """
         print "Scanner resolution: %d" % (scan_res)
         print "Scanner calibration: %s" % (str(scanner_calibration))
@@ -270,100 +214,176 @@ class ImgPage(BasicPage):
         img.load()  # WORKAROUND: For PIL on ArchLinux
 
         # strip the alpha channel if there is one
-        color_channels = img.split()
-        img = Image.merge("RGB", color_channels[:3])
-
-        outfiles = []
-        # rotate the image 0, 90, 180 and 270 degrees
-        for rotation in range(0, 4):
-            filename = ("%s%d.%s" % (self.ROTATED_FILE_PREFIX, rotation,
-                                     self.EXT_IMG_SCAN))
-            imgpath = os.path.join(self.doc.path, filename)
-            print ("Saving scan (rotated %d degree) in '%s'"
-                   % (rotation * -90, imgpath))
-            img.save(imgpath)
-            outfiles.append(imgpath)
-            img = img.rotate(-90)
-        return outfiles
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        return img
+
+    def __save_img(self, img):
+        """
+        Save the scan in a temporary file (<docid>/paper.rotated.0.bmp).
+        Only used if the OCR can't be done on the scan kept in memory.
+        """
+        filename = ("%s%d.%s" % (self.ROTATED_FILE_PREFIX, 0,
+                                 self.EXT_IMG_SCAN))
+        imgpath = os.path.join(self.doc.path, filename)
+        print "Saving scan in '%s'" % (imgpath)
+        img.save(imgpath)
+        return imgpath
+
+    @classmethod
+    def __rotate(cls, img, rotation):
+        """
+        Rotate the image by 'rotation' quarter turns clockwise
+        """
+        if cls.ROTATIONS[rotation] is None:
+            return img
+        return img.transpose(cls.ROTATIONS[rotation])
+
+    @classmethod
+    def __get_orientation_sample(cls, img):
+        """
+        Extract a part of the page likely to contain text: the most
+        contrasted area among a few candidates (half the width and a quarter
+        of the height of the page each). It is also downscaled if required.
+        """
+        (width, height) = img.size
+        preview = img.resize((max(1, width / 8), max(1, height / 8)))
+        preview = preview.convert("L")
+        (preview_w, preview_h) = preview.size
+
+        best = (-1.0, (0, 0, width, height))
+        for x in range(0, 3):
+            for y in range(0, 7):
+                area = (x * preview_w / 4, y * preview_h / 8,
+                        (x + 2) * preview_w / 4, (y + 2) * preview_h / 8)
+                if area[2] <= area[0] or area[3] <= area[1]:
+                    continue
+                contrast = ImageStat.Stat(preview.crop(area)).stddev[0]
+                if contrast > best[0]:
+                    best = (contrast, tuple([coord * 8 for coord in area]))
+
+        sample = img.crop(best[1])
+        sample.load()
+        factor = (float(cls.ORIENTATION_SAMPLE_MAX_SIZE)
+                  / max(sample.size[0], sample.size[1]))
+        if factor < 1.0:
+            sample = sample.resize((int(sample.size[0] * factor),
+                                    int(sample.size[1] * factor)),
+                                   Image.ANTIALIAS)
+        return sample
 
     @staticmethod
-    def __compare_score(score_x, score_y):
+    def __detect_orientation(ocr_tool, img, langs):
         """
-        Compare scores
+        Use the orientation detection of the OCR tool, if available
 
         Returns:
-            -1 : if X is lower than Y
-            1 : if X is higher than Y
-            0 : if both are equal
-        """
-        if score_x < score_y:
-            return -1
-        elif score_x > score_y:
-            return 1
-        else:
-            return 0
+            The number of quarter turns clockwise required to put the page
+            upright. None if the OCR tool can't tell.
+        """
+        if (not hasattr(ocr_tool, "can_detect_orientation")
+                or not ocr_tool.can_detect_orientation()):
+            return None
+        try:
+            orientation = ocr_tool.detect_orientation(img, lang=langs['ocr'])
+        except Exception, exc:
+            print "Orientation detection failed: %s" % (str(exc))
+            return None
+        # the page must be rotated by 'angle' degrees counter-clockwise
+        return (-int(orientation['angle']) / 90) % 4
 
-    def __ocr(self, files, langs, callback=dummy_progress_cb):
+    def __find_orientation(self, ocr_tool, img, langs,
+                           callback=dummy_progress_cb):
         """
-        Do the OCR on the page
+        Find how the page must be rotated. Instead of running the OCR on the
+        whole page in all the possible orientations, we only do it on a small
+        sample of the page.
+
+        Returns:
+            The number of quarter turns clockwise required to put the page
+            upright.
         """
+        callback(0, 100, self.SCAN_STEP_OCR)
+        rotation = self.__detect_orientation(ocr_tool, img, langs)
+        if rotation is not None:
+            print "Orientation detected by the OCR tool: %d" % (rotation)
+            return rotation
+
+        sample = self.__get_orientation_sample(img)
+        jobs = [OCR_EXECUTOR.ocr_image(self.__rotate(sample, rotation), langs,
+                                       need_score=True)
+                for rotation in range(0, 4)]
+        scores = []
+        for (rotation, job) in enumerate(jobs):
+            try:
+                (score, boxes) = job.result()
+            except Exception, exc:
+                print ("OCR on sample (rotation: %d) failed: %s"
+                       % (rotation, str(exc)))
+                score = -1
+            # on equal scores, we prefer to not rotate the page
+            scores.append((score, rotation == 0, rotation))
+        scores.sort(reverse=True)
+        print "Best orientation: %d (score: %d)" % (scores[0][2],
+                                                   scores[0][0])
+        return scores[0][2]
 
-        files = files[:]
-        need_scores = len(files) > 1
+    def __ocr(self, files, langs, callback=dummy_progress_cb):
+        """
+        Do the OCR on the page. The OCR is run by the OCR executor, on all
+        the images at the same time.
 
-        callback(0, 100, self.SCAN_STEP_OCR)
+        Arguments:
+            files --- list of (image path, PIL image). If the PIL image is
+                None, the image is loaded from the path.
 
-        ocr_tools = pyocr.pyocr.get_available_tools()
-        if len(ocr_tools) <= 0:
-            # shouldn't happen: scan buttons should be disabled
-            # in that case
-            callback(0, 100, self.SCAN_STEP_OCR)
-            raise Exception("No OCR tool available")
-        print "Using %s for OCR" % (ocr_tools[0].get_name())
+        Returns:
+            (image path, text, boxes) of the best result
 
-        max_threads = multiprocessing.cpu_count()
-        threads = []
+        Raises:
+            The exception raised by the OCR tool if it failed on all the
+            images
+        """
+        need_scores = len(files) > 1
 
-        if len(files) > 1:
-            print "Will use %d process(es) for OCR" % (max_threads)
+        callback(0, 100, self.SCAN_STEP_OCR)
 
-        scores = []
+        jobs = {}  # job --> image path
+        for (imgpath, img) in files:
+            print ("Running OCR on '%s'" % imgpath)
+            if img is None:
+                img = imgpath
+            jobs[OCR_EXECUTOR.ocr_image(img, langs, need_scores)] = imgpath
 
-        # Run the OCR tools in as many threads as there are processors/core
-        # on the computer
-        while (len(files) > 0 or len(threads) > 0):
-            # look for finished threads
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-                    scores.append((thread.score, thread.imgpath, thread.text))
-                    callback(len(scores),
-                             len(scores) + len(files) + len(threads) + 1,
-                             self.SCAN_STEP_OCR)
-            # start new threads if required
-            while (len(threads) < max_threads and len(files) > 0):
-                imgpath = files.pop()
-                thread = ImgOCRThread(ocr_tools[0], langs, imgpath,
-                                      need_scores)
-                thread.start()
-                threads.append(thread)
-            time.sleep(self.OCR_THREADS_POLLING_TIME)
+        scores = []
+        errors = []
+        try:
+            for job in as_completed(jobs.keys()):
+                imgpath = jobs.pop(job)
+                try:
+                    (score, boxes) = job.result()
+                except Exception, exc:
+                    print "OCR on '%s' failed: %s" % (imgpath, str(exc))
+                    errors.append(exc)
+                    continue
+                scores.append((score, imgpath, boxes_to_text(boxes), boxes))
+                callback(len(scores) + len(errors), len(files) + 1,
+                         self.SCAN_STEP_OCR)
+        finally:
+            for job in jobs.keys():
+                job.cancel()
+
+        if len(scores) <= 0:
+            callback(100, 100, self.SCAN_STEP_OCR)
+            raise errors[0]
 
         # We want the higher score first
-        scores.sort(cmp=lambda x, y: self.__compare_score(y[0], x[0]))
+        scores.sort(key=lambda score: score[0], reverse=True)
 
         print "Best: %f -> %s" % (scores[0][0], scores[0][1])
 
-        print "Extracting boxes ..."
-        callback(len(scores), len(scores) + 1, self.SCAN_STEP_OCR)
-        builder = pyocr.builders.LineBoxBuilder()
-        boxes = ocr_tools[0].image_to_string(Image.open(scores[0][1]),
-                                             lang=langs['ocr'],
-                                             builder=builder)
-        print "Done"
-
         callback(100, 100, self.SCAN_STEP_OCR)
-        return (scores[0][1], scores[0][2], boxes)
+        return (scores[0][1], scores[0][2], scores[0][3])
 
     def make(self, img, langs=None, scan_res=0, scanner_calibration=None,
              callback=dummy_progress_cb):
@@ -373,24 +393,42 @@ class ImgPage(BasicPage):
         imgfile = self.__img_path
         boxfile = self.__box_path
 
-        outfiles = self.__save_imgs(img, scan_res, scanner_calibration,
-                                    callback)
-        if langs is None:
-            (bmpfile, txt, boxes) = (outfiles[0], "", [])
-        else:
-            (bmpfile, txt, boxes) = self.__ocr(outfiles, langs, callback)
-
-        # Convert the image and save it in its final place
-        img = Image.open(bmpfile)
+        img = self.__prepare_img(img, scan_res, scanner_calibration)
+        if langs is not None:
+            ocr_tools = pyocr.pyocr.get_available_tools()
+            if len(ocr_tools) <= 0:
+                # shouldn't happen: scan buttons should be disabled
+                # in that case
+                raise Exception("No OCR tool available")
+            rotation = self.__find_orientation(ocr_tools[0], img, langs,
+                                               callback)
+            img = self.__rotate(img, rotation)
+
+        (txt, boxes) = ("", [])
+        if langs is not None:
+            try:
+                (_, txt, boxes) = self.__ocr([("scan", img)], langs, callback)
+            except MemoryError:
+                # the scan must be copied to be sent to the OCR processes:
+                # on small computers, we fall back on a temporary file that
+                # they will load by themselves
+                print ("Not enough memory to do the OCR on the scan,"
+                       " using a temporary file")
+                outfile = self.__save_img(img)
+                img = None
+                try:
+                    (_, txt, boxes) = self.__ocr([(outfile, None)], langs,
+                                                 callback)
+                    img = Image.open(outfile)
+                    img.load()
+                finally:
+                    os.unlink(outfile)
+
+        # Save the image in its final place
         img.save(imgfile)
 
         # Save the boxes
-        with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
-            pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
-
-        # delete temporary files
-        for outfile in outfiles:
-            os.unlink(outfile)
+        boxcache.write_boxes(boxfile, self.__get_box_cache_path(), boxes)
 
         print "Scan done"
         self.drop_cache()
@@ -448,11 +486,10 @@ class ImgPage(BasicPage):
         imgfile = self.__img_path
         boxfile = self.__box_path
 
-        (imgfile, txt, boxes) = self.__ocr([imgfile], langs,
+        (imgfile, txt, boxes) = self.__ocr([(imgfile, None)], langs,
                                            dummy_progress_cb)
         # save the boxes
-        with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
-            pyocr.builders.LineBoxBuilder.write_file(file_desc, boxes)
+        boxcache.write_boxes(boxfile, self.__get_box_cache_path(), boxes)
         self.drop_cache()
         self.doc.drop_cache()
 
@@ -467,6 +504,8 @@ class ImgPage(BasicPage):
         src["box"] = self.__get_box_path()
         src["img"] = self.__get_img_path()
         src["thumb"] = self.__get_thumb_path()
+        src["word_map"] = self.__get_word_map_path()
+        src["box_cache"] = self.__get_box_cache_path()
 
         page_nb = self.page_nb
 
@@ -482,6 +521,8 @@ class ImgPage(BasicPage):
         dst["box"] = self.__get_box_path()
         dst["img"] = self.__get_img_path()
         dst["thumb"] = self.__get_thumb_path()
+        dst["word_map"] = self.__get_word_map_path()
+        dst["box_cache"] = self.__get_box_cache_path()
 
         for key in src.keys():
             if os.access(src[key], os.F_OK):
@@ -541,6 +582,8 @@ class ImgPage(BasicPage):
             self.__get_box_path(),
             self.__get_img_path(),
             self.__get_thumb_path(),
+            self.__get_word_map_path(),
+            self.__get_box_cache_path(),
         ]
         for path in paths:
             if os.access(path, os.F_OK):
@@ -563,8 +606,18 @@ class ImgPage(BasicPage):
         to_move = [
             (other_page.__get_box_path(), self.__get_box_path()),
             (other_page.__get_img_path(), self.__get_img_path()),
-            (other_page.__get_thumb_path(), self.__get_thumb_path())
         ]
+        if os.access(other_page.__get_thumb_path(), os.F_OK):
+            to_move.append((other_page.__get_thumb_path(),
+                            self.__get_thumb_path()))
+        # the word map and the box cache are optional: they can be rebuilt
+        # from the boxes
+        if os.access(other_page.__get_word_map_path(), os.F_OK):
+            to_move.append((other_page.__get_word_map_path(),
+                            self.__get_word_map_path()))
+        if os.access(other_page.__get_box_cache_path(), os.F_OK):
+            to_move.append((other_page.__get_box_cache_path(),
+                            self.__get_box_cache_path()))
         for (src, dst) in to_move:
             # sanity check
             if os.access(dst, os.F_OK):
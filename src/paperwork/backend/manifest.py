@@ -0,0 +1,153 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keep track of the state of the document directories as they were when they
+were last indexed. It allows to find quickly the documents that have been
+modified since then, without having to instantiate all of them.
+"""
+
+import cPickle
+import os
+import os.path
+import re
+import threading
+import time
+
+
+# Only the files that have an effect on the index content are tracked.
+# Thumbnails, caches, etc are ignored.
+TRACKED_FILES_REGEX = re.compile(
+    r"^(labels|extra\.txt|doc\.pdf|paper\.\d+\.(jpg|txt|words))$")
+
+
+class DocDirManifest(object):
+    """
+    Persistent record of the document directories: for each of them, it
+    stores the mtime of the directory and the mtime and the size of each of
+    its relevant files.
+    """
+    FILENAME = "docdirs.manifest"
+    VERSION = 1
+
+    # mtimes are not always precise: if a directory has been modified just
+    # before being recorded, we can't trust its record.
+    MTIME_PRECISION = 2.0
+
+    def __init__(self, indexdir):
+        self.__path = os.path.join(indexdir, self.FILENAME)
+        self.__lock = threading.Lock()
+        # docid --> (record time, dir mtime, { filename: (mtime, size) })
+        self.__entries = {}
+        self.load()
+
+    def load(self):
+        """
+        (Re)load the manifest from the disk
+        """
+        entries = {}
+        try:
+            with open(self.__path, 'rb') as file_desc:
+                (version, entries) = cPickle.load(file_desc)
+            if version != self.VERSION:
+                print ("Manifest '%s' has an unknown version (%s). Ignored"
+                       % (self.__path, str(version)))
+                entries = {}
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError), exc:
+            print "Unable to read manifest '%s': %s" % (self.__path, str(exc))
+        with self.__lock:
+            self.__entries = entries
+
+    def save(self):
+        """
+        Write the manifest on the disk
+        """
+        with self.__lock:
+            entries = self.__entries.copy()
+        tmp_path = self.__path + ".tmp"
+        with open(tmp_path, 'wb') as file_desc:
+            cPickle.dump((self.VERSION, entries), file_desc,
+                         cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.__path)
+
+    @staticmethod
+    def __get_signature(docpath):
+        """
+        Returns:
+            (directory mtime, { filename: (file mtime, file size) })
+        """
+        dir_mtime = os.stat(docpath).st_mtime
+        files = {}
+        for filename in os.listdir(docpath):
+            if not TRACKED_FILES_REGEX.match(filename):
+                continue
+            try:
+                stat = os.stat(os.path.join(docpath, filename))
+            except OSError:
+                # file removed in the meantime
+                continue
+            files[filename] = (stat.st_mtime, stat.st_size)
+        return (dir_mtime, files)
+
+    def update(self, docid, docpath):
+        """
+        Record the current state of a document directory
+        """
+        now = time.time()
+        try:
+            (dir_mtime, files) = self.__get_signature(docpath)
+        except OSError, exc:
+            print ("Manifest: Unable to examine '%s': %s"
+                   % (docpath, str(exc)))
+            self.remove(docid)
+            return
+        with self.__lock:
+            self.__entries[docid] = (now, dir_mtime, files)
+
+    def remove(self, docid):
+        """
+        Forget about a document directory
+        """
+        with self.__lock:
+            self.__entries.pop(docid, None)
+
+    def is_unchanged(self, docid, docpath):
+        """
+        Check that a document directory is still in the state recorded.
+        Only the directory and the files recorded are stat()'ed: the directory
+        is not listed and the document is not opened.
+
+        Returns:
+            True if it is unchanged. False if it has been modified or if it
+            is unknown.
+        """
+        with self.__lock:
+            entry = self.__entries.get(docid)
+        if entry is None:
+            return False
+        (record_time, dir_mtime, files) = entry
+        if dir_mtime >= record_time - self.MTIME_PRECISION:
+            return False
+        try:
+            if os.stat(docpath).st_mtime != dir_mtime:
+                return False
+            for (filename, (mtime, size)) in files.iteritems():
+                stat = os.stat(os.path.join(docpath, filename))
+                if stat.st_mtime != mtime or stat.st_size != size:
+                    return False
+        except OSError:
+            return False
+        return True
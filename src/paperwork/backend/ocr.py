@@ -0,0 +1,507 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Shared OCR executor.
+
+The OCR and the scoring of its results (spell checking) are CPU-bound, so
+they are run in a pool of processes. Jobs submitted to the executor are
+represented by futures (OcrJob). Only as many jobs as there are processes
+are given to the pool at a time: the others wait in a bounded queue, where
+they can still be cancelled. Submitting a job while the queue is full blocks
+until there is room in it.
+
+If a worker process dies (killed, crashed, ...), the pool never returns the
+result of the job it was running. So each worker process tells the executor
+which job it is running, and a watchdog thread periodically checks that the
+processes running jobs are still alive. The jobs of the dead ones fail with
+WorkerDied.
+
+OcrExecutor itself can run any module-level function: the thumbnailer uses
+an instance of its own (see paperwork.backend.thumbnailer).
+
+Images and pages can't be sent as such to another process: images are sent
+as raw buffers (or as paths) and pages as (doc type, doc path, doc id, page
+number).
+"""
+
+import collections
+import errno
+import multiprocessing
+import os
+import pickle
+import Queue
+import re
+import threading
+
+import Image
+import pyocr.builders
+import pyocr.pyocr
+
+from paperwork.util import boxes_to_text
+from paperwork.util import check_spelling
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class WorkerDied(Exception):
+    pass
+
+
+def _get_ocr_tool():
+    ocr_tools = pyocr.pyocr.get_available_tools()
+    if len(ocr_tools) <= 0:
+        # shouldn't happen: scan buttons should be disabled
+        # in that case
+        raise Exception("No OCR tool available")
+    return ocr_tools[0]
+
+
+def _compute_score_with_spell_checking(langs, txt):
+    return check_spelling(langs['spelling'], txt)
+
+
+def _compute_score_without_spell_checking(langs, txt):
+    """
+    Try to evaluate how well the OCR worked.
+    Current implementation:
+        The score is the number of words only made of 4 or more letters
+        ([a-zA-Z])
+    """
+    # TODO(Jflesch): i18n / l10n
+    score = 0
+    prog = re.compile(r'^[a-zA-Z]{4,}$')
+    for word in txt.split(" "):
+        if prog.match(word):
+            score += 1
+    return (txt, score)
+
+
+SCORE_METHODS = [
+    ("spell_checker", _compute_score_with_spell_checking),
+    ("lucky_guess", _compute_score_without_spell_checking),
+]
+
+
+def compute_score(langs, txt):
+    """
+    Evaluate how well the OCR worked on the text 'txt'
+    """
+    for (method_name, method) in SCORE_METHODS:
+        try:
+            # TODO(Jflesch): For now, we throw away the fixed version:
+            # The original version may contain proper nouns, and spell
+            # checking could make them disappear
+            # However, it would be best if we could keep both versions
+            # without increasing too much indexation time
+            (fixed_txt, score) = method(langs, txt)
+            return score
+        except Exception, exc:
+            print ("**WARNING** Scoring method '%s' failed !" % method_name)
+            print ("Reason: %s" % (str(exc)))
+    return 0
+
+
+def _load_img(img_desc):
+    """
+    Arguments:
+        img_desc --- a path or (mode, size, raw data) (see image_to_desc())
+    """
+    if isinstance(img_desc, basestring):
+        img = Image.open(img_desc)
+        img.load()
+        return img
+    (mode, size, data) = img_desc
+    return Image.fromstring(mode, size, data)
+
+
+def image_to_desc(img):
+    """
+    Turn a PIL image into something that can be sent to the worker processes
+    """
+    return (img.mode, img.size, img.tostring())
+
+
+def _ocr_image(img_desc, langs, need_score):
+    """
+    Called in the worker processes
+
+    Returns:
+        (score, boxes). The score is 0 if not required.
+    """
+    img = _load_img(img_desc)
+    # a single OCR pass gives us both the boxes and the text
+    builder = pyocr.builders.LineBoxBuilder()
+    boxes = _get_ocr_tool().image_to_string(img, lang=langs['ocr'],
+                                            builder=builder)
+    score = 0
+    if need_score:
+        score = compute_score(langs, boxes_to_text(boxes))
+        print "OCR score: %d" % (score)
+    return (score, boxes)
+
+
+def _redo_page_ocr(page_desc, langs):
+    """
+    Called in the worker processes
+    """
+    (doc_type, docpath, docid, page_nb) = page_desc
+    doc = doc_type(docpath, docid)
+    doc.pages[page_nb].redo_ocr(langs)
+
+
+# in the worker processes: (lock, pipe) used to tell the executor which job
+# each process is running (see OcrExecutor.__watch()). Unlike with a
+# multiprocessing.Queue (flushed by a background thread), the message is
+# written as soon as send() returns: it's not lost if the process dies
+# right after.
+_STARTED_JOBS = None
+
+
+def _init_worker(lock, started_jobs):
+    global _STARTED_JOBS
+    _STARTED_JOBS = (lock, started_jobs)
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, exc:
+        return exc.errno != errno.ESRCH
+    return True
+
+
+def _run_job(job_id, func, args):
+    """
+    Called in the worker processes. Exceptions are sent back to the main
+    process as results: apply_async() has no error callback.
+    """
+    if job_id is not None and _STARTED_JOBS is not None:
+        (lock, started_jobs) = _STARTED_JOBS
+        with lock:
+            started_jobs.send((job_id, os.getpid()))
+    try:
+        return (True, func(*args))
+    except Exception, exc:
+        try:
+            # some exceptions can't be sent back as such (for instance the
+            # ones with mandatory arguments in their constructor)
+            pickle.loads(pickle.dumps(exc))
+        except Exception:
+            exc = Exception("%s: %s" % (type(exc).__name__, str(exc)))
+        return (False, exc)
+
+
+class OcrJob(object):
+    """
+    Future of a job submitted to the OCR executor
+    """
+
+    def __init__(self, executor, func, args):
+        self.__executor = executor
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.__done = threading.Event()
+        self.__result = None
+        self.__exc = None
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def _set_result(self, result):
+        (success, result) = result
+        with self.__lock:
+            if success:
+                self.__result = result
+            else:
+                self.__exc = result
+            self.__done.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def _run(self):
+        self._set_result(_run_job(None, self.func, self.args))
+
+    def _cancel(self):
+        self.cancelled = True
+        self._set_result((False, JobCancelled()))
+
+    def cancel(self):
+        """
+        Cancel the job if it hasn't been started yet
+
+        Returns:
+            True if the job has been cancelled
+        """
+        return self.__executor._cancel(self)
+
+    def add_done_callback(self, callback):
+        """
+        callback(job) will be called once the job is done (or cancelled).
+        Beware that it may be called from another thread.
+        """
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def done(self):
+        return self.__done.is_set()
+
+    def wait(self):
+        self.__done.wait()
+
+    def result(self):
+        """
+        Wait for the job to be done, and return its result
+
+        Raises:
+            JobCancelled if the job has been cancelled. The exception
+            raised by the job if it failed.
+        """
+        self.wait()
+        if self.__exc is not None:
+            raise self.__exc
+        return self.__result
+
+
+def as_completed(jobs):
+    """
+    Returns:
+        A generator of the jobs, in the order in which they are done
+    """
+    done = Queue.Queue()
+    jobs = list(jobs)
+    for job in jobs:
+        job.add_done_callback(done.put)
+    for _ in jobs:
+        yield done.get()
+
+
+class OcrExecutor(object):
+    # seconds between two checks of the worker processes
+    WATCHDOG_PERIOD = 1.0
+
+    def __init__(self, nb_processes=None, max_queued=None):
+        if nb_processes is None:
+            nb_processes = multiprocessing.cpu_count()
+        if max_queued is None:
+            max_queued = 4 * nb_processes
+        self.nb_processes = nb_processes
+        self.max_queued = max_queued
+        self.__pool = None
+        self.__started_jobs = None
+        self.__queue = collections.deque()
+        self.__running = {}  # id(job) --> job
+        self.__pids = {}  # id(job) --> pid of the process running it
+        self.__cond = threading.Condition()
+
+    def __get_pool(self):
+        if self.__pool is None:
+            (reader, writer) = multiprocessing.Pipe(duplex=False)
+            self.__started_jobs = writer
+            self.__pool = multiprocessing.Pool(
+                self.nb_processes, _init_worker,
+                (multiprocessing.Lock(), writer))
+            watchdog = threading.Thread(target=self.__watch, args=(reader, ))
+            watchdog.daemon = True
+            watchdog.start()
+        return self.__pool
+
+    def __watch(self, started_jobs):
+        """
+        Watchdog thread: fails the jobs of the worker processes that died
+        """
+        while True:
+            started = []
+            timeout = self.WATCHDOG_PERIOD
+            while started_jobs.poll(timeout):
+                (job_id, pid) = started_jobs.recv()
+                if job_id is None:
+                    # executor closed
+                    started_jobs.close()
+                    return
+                started.append((job_id, pid))
+                timeout = 0
+            dead = []
+            with self.__cond:
+                for (job_id, pid) in started:
+                    if job_id in self.__running:
+                        self.__pids[job_id] = pid
+                for (job_id, pid) in self.__pids.items():
+                    if not _is_process_alive(pid):
+                        dead.append((self.__running.pop(job_id), pid))
+                        self.__pids.pop(job_id)
+                if len(dead) > 0:
+                    self.__dispatch()
+            for (job, pid) in dead:
+                msg = ("Worker process %d died while running %s"
+                       % (pid, job.func.__name__))
+                print msg
+                job._set_result((False, WorkerDied(msg)))
+
+    def __dispatch(self):
+        """
+        Give jobs to the pool, as long as it has idle processes.
+        Must be called with self.__cond acquired.
+        """
+        while (len(self.__running) < self.nb_processes
+               and len(self.__queue) > 0):
+            job = self.__queue.popleft()
+            self.__running[id(job)] = job
+            self.__get_pool().apply_async(
+                _run_job, (id(job), job.func, job.args),
+                callback=lambda result, job=job: self.__on_done(job, result))
+        self.__cond.notify_all()
+
+    def __on_done(self, job, result):
+        """
+        Called from the result handler thread of the pool
+        """
+        with self.__cond:
+            if self.__running.get(id(job)) is not job:
+                # executor closed in the meantime
+                return
+            self.__running.pop(id(job))
+            self.__pids.pop(id(job), None)
+            self.__dispatch()
+        job._set_result(result)
+
+    def _cancel(self, job):
+        with self.__cond:
+            try:
+                self.__queue.remove(job)
+            except ValueError:
+                # already running or done
+                return False
+            self.__cond.notify_all()
+        job._cancel()
+        return True
+
+    def submit(self, func, *args):
+        """
+        Submit a job. Blocks if the queue is full.
+
+        Arguments:
+            func --- module-level function that will be called in a worker
+                process with the arguments 'args'
+
+        Returns:
+            A future (OcrJob)
+        """
+        job = OcrJob(self, func, args)
+        if multiprocessing.current_process().daemon:
+            # we are already in a worker process, and pools can't be nested
+            job._run()
+            return job
+        with self.__cond:
+            while len(self.__queue) >= self.max_queued:
+                self.__cond.wait()
+            self.__queue.append(job)
+            self.__dispatch()
+        return job
+
+    def ocr_image(self, img, langs, need_score=False):
+        """
+        Run the OCR on an image (a PIL image or a path)
+
+        Returns:
+            A future. Its result will be (score, boxes).
+        """
+        if not isinstance(img, basestring):
+            img = image_to_desc(img)
+        return self.submit(_ocr_image, img, langs, need_score)
+
+    def redo_page_ocr(self, doc, page_nb, langs):
+        """
+        Run the OCR again on a page (see BasicPage.redo_ocr())
+
+        Returns:
+            A future
+        """
+        page_desc = (type(doc), doc.path, doc.docid, page_nb)
+        return self.submit(_redo_page_ocr, page_desc, langs)
+
+    def redo_ocr(self, pages, langs, progress_callback):
+        """
+        Run the OCR again on the pages, as many at the same time as there
+        are worker processes.
+
+        Arguments:
+            pages --- list of (doc, page number)
+            progress_callback --- progress_callback(nb pages done, nb pages,
+                doc). May raise an exception to interrupt the process: the
+                pages not started yet are then cancelled.
+        """
+        pages = pages[::-1]
+        nb_pages = len(pages)
+        nb_done = 0
+        running = {}  # job --> doc
+        done = Queue.Queue()
+        try:
+            while len(pages) > 0 or len(running) > 0:
+                while len(pages) > 0 and len(running) < self.max_queued:
+                    (doc, page_nb) = pages.pop()
+                    job = self.redo_page_ocr(doc, page_nb, langs)
+                    running[job] = doc
+                    job.add_done_callback(done.put)
+                job = done.get()
+                doc = running.pop(job)
+                try:
+                    job.result()
+                except Exception, exc:
+                    print ("Unable to redo the OCR of a page of %s: %s"
+                           % (str(doc), str(exc)))
+                # the page has been updated by another process
+                doc.drop_cache()
+                nb_done += 1
+                progress_callback(nb_done, nb_pages, doc)
+        finally:
+            for job in running.keys():
+                job.cancel()
+            # wait for the pages currently being updated
+            for job in running.keys():
+                job.wait()
+
+    def close(self):
+        with self.__cond:
+            jobs = list(self.__queue) + self.__running.values()
+            self.__queue.clear()
+            self.__running.clear()
+            self.__pids.clear()
+            pool = self.__pool
+            self.__pool = None
+            started_jobs = self.__started_jobs
+            self.__started_jobs = None
+            self.__cond.notify_all()
+        # jobs currently running are killed with the pool
+        for job in jobs:
+            job._cancel()
+        if pool is None:
+            return
+        pool.terminate()
+        pool.join()
+        # stops the watchdog
+        started_jobs.send((None, None))
+        started_jobs.close()
+
+
+OCR_EXECUTOR = OcrExecutor()
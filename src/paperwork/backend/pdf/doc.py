@@ -23,12 +23,36 @@ from gi.repository import Gio
 from gi.repository import Poppler
 
 from paperwork.backend.common.doc import BasicDoc
+from paperwork.backend.config import DEFAULT_MAX_OPEN_PDFS
 from paperwork.backend.pdf.page import PdfPage
+from paperwork.backend.pdf.page import PDF_FILENAME
+from paperwork.util import LRUCache
 
 
-PDF_FILENAME = "doc.pdf"
 PDF_IMPORT_MIN_KEYWORDS = 5
 
+# Opened PDF files are kept in a process-wide LRU cache, so we never have
+# thousands of them parsed in memory at the same time (and as many open file
+# descriptors). Its size comes from the configuration (see
+# set_max_open_pdfs() and PaperworkConfig.max_open_pdfs). Processes that
+# don't read the configuration get the default size.
+#
+# id(PdfDoc) --> (PdfDoc, Poppler.Document). The PdfDoc is referenced so it
+# can't be garbage-collected (and its id reused) while it is in the cache.
+#
+# The pages of a document (PdfPages) are not part of this cache: they are
+# kept by the PdfDoc, with their own caches (text, boxes, etc), when the
+# PDF file is closed and reopened. They don't keep any reference on the
+# Poppler document (see PdfPage.pdf_page), so closing the file does free it.
+_OPEN_PDFS = LRUCache(DEFAULT_MAX_OPEN_PDFS)
+
+
+def set_max_open_pdfs(max_open_pdfs):
+    """
+    Change the maximum number of PDF files kept open at the same time
+    """
+    _OPEN_PDFS.resize(max(1, max_open_pdfs))
+
 
 class PdfDocExporter(object):
     can_select_format = False
@@ -58,10 +82,14 @@ class PdfDocExporter(object):
 
 
 class PdfPagesIterator(object):
+    """
+    Iterates on the pages of a PDF document. Pages are instantiated only when
+    reached.
+    """
+
     def __init__(self, pdfdoc):
         self.pdfdoc = pdfdoc
         self.idx = 0
-        self.pages = [pdfdoc.pages[i] for i in range(0, pdfdoc.nb_pages)]
 
     def __iter__(self):
         return self
@@ -69,17 +97,29 @@ class PdfPagesIterator(object):
     def next(self):
         if self.idx >= self.pdfdoc.nb_pages:
             raise StopIteration()
-        page = self.pages[self.idx]
+        page = self.pdfdoc.pages[self.idx]
         self.idx += 1
         return page
 
 
 class PdfPages(object):
+    """
+    Page list. The most recently used pages are kept, so their caches (text,
+    boxes, etc) are kept too (until PdfDoc.drop_cache()), even if the PDF
+    file is closed in the meantime.
+    """
+    PAGE_CACHE_SIZE = 32
+
     def __init__(self, pdfdoc):
         self.pdfdoc = pdfdoc
+        self.__pages = LRUCache(self.PAGE_CACHE_SIZE)
 
     def __getitem__(self, idx):
-        return PdfPage(self.pdfdoc, idx)
+        page = self.__pages.get(idx)
+        if page is None:
+            page = PdfPage(self.pdfdoc, idx)
+            self.__pages[idx] = page
+        return page
 
     def __len__(self):
         return self.pdfdoc.nb_pages
@@ -94,8 +134,7 @@ class PdfDoc(BasicDoc):
 
     def __init__(self, docpath, docid=None):
         BasicDoc.__init__(self, docpath, docid)
-        self.__pdf = None
-        self.__nb_pages = 0
+        self.__nb_pages = None
         self.__pages = None
 
     def __get_last_mod(self):
@@ -124,28 +163,37 @@ class PdfDoc(BasicDoc):
     last_mod = property(__get_last_mod)
 
     def _open_pdf(self):
-        self.__pdf = Poppler.Document.new_from_file(
+        """
+        (Re)open the PDF file. It may be closed again at any time if too many
+        other PDF files are opened (see set_max_open_pdfs()).
+
+        Returns:
+            Poppler.Document
+        """
+        pdf = Poppler.Document.new_from_file(
             ("file://%s/%s" % (self.path, PDF_FILENAME)),
             password=None)
-        self.__nb_pages = self.pdf.get_n_pages()
-        self.__pages = PdfPages(self)
+        self.__nb_pages = pdf.get_n_pages()
+        _OPEN_PDFS[id(self)] = (self, pdf)
+        return pdf
 
     def __get_pdf(self):
-        if self.__pdf is None:
-            self._open_pdf()
-        return self.__pdf
+        opened = _OPEN_PDFS.get(id(self))
+        if opened is None:
+            return self._open_pdf()
+        return opened[1]
 
     pdf = property(__get_pdf)
 
     def __get_pages(self):
-        if self.__pdf is None:
-            self._open_pdf()
+        if self.__pages is None:
+            self.__pages = PdfPages(self)
         return self.__pages
 
     pages = property(__get_pages)
 
     def _get_nb_pages(self):
-        if self.__pdf is None:
+        if self.__nb_pages is None:
             self._open_pdf()
         return self.__nb_pages
 
@@ -186,9 +234,8 @@ class PdfDoc(BasicDoc):
 
     def drop_cache(self):
         BasicDoc.drop_cache(self)
-        del(self.__pdf)
-        self.__pdf = None
-        del(self.__pages)
+        _OPEN_PDFS.pop(id(self))
+        self.__nb_pages = None
         self.__pages = None
 
 
@@ -20,7 +20,10 @@ import os
 import pyocr.builders
 import pyocr.pyocr
 
+from paperwork.backend.common import boxcache
 from paperwork.backend.common.page import BasicPage
+from paperwork.util import LRUCache
+from paperwork.util import boxes_to_text
 from paperwork.util import split_words
 from paperwork.util import surface2image
 
@@ -29,46 +32,73 @@ from paperwork.util import surface2image
 # so we increase their size
 PDF_RENDER_FACTOR = 2
 
+PDF_FILENAME = "doc.pdf"
+
+# Tiles are square. At most TILE_CACHE_SIZE tiles are kept in memory
+# (~1MB each)
+TILE_SIZE = 512
+TILE_CACHE_SIZE = 64
+
+# (docid, page number, zoom factor, tile x, tile y) --> cairo.ImageSurface
+_TILE_CACHE = LRUCache(TILE_CACHE_SIZE)
+
+
+def _get_position(x1, y1, x2, y2):
+    """
+    Convert a rectangle in the PDF page (in points) into a box position in
+    PdfPage.img
+    """
+    return ((int(x1 * PDF_RENDER_FACTOR), int(y1 * PDF_RENDER_FACTOR)),
+            (int(x2 * PDF_RENDER_FACTOR), int(y2 * PDF_RENDER_FACTOR)))
+
+
+def _get_bounding_position(positions):
+    """
+    Returns the smallest position containing all the given ones
+    """
+    return ((min([position[0][0] for position in positions]),
+             min([position[0][1] for position in positions])),
+            (max([position[1][0] for position in positions]),
+             max([position[1][1] for position in positions])))
+
 
 class PdfWordBox(object):
-    def __init__(self, content, rectangle, pdf_size):
+    def __init__(self, content, position):
         self.content = content
-        # XXX(Jflesch): Coordinates seem to come from the bottom left of the
-        # page instead of the top left !?
-        self.position = ((int(rectangle.x1 * PDF_RENDER_FACTOR),
-                         int((pdf_size[1] - rectangle.y2)
-                             * PDF_RENDER_FACTOR)),
-                        (int(rectangle.x2 * PDF_RENDER_FACTOR),
-                         int((pdf_size[1] - rectangle.y1)
-                             * PDF_RENDER_FACTOR)))
+        self.position = position
 
 
 class PdfLineBox(object):
-    def __init__(self, word_boxes, rectangle, pdf_size):
+    def __init__(self, word_boxes, position):
         self.word_boxes = word_boxes
-        # XXX(Jflesch): Coordinates seem to come from the bottom left of the
-        # page instead of the top left !?
-        self.position = ((int(rectangle.x1 * PDF_RENDER_FACTOR),
-                         int((pdf_size[1] - rectangle.y2)
-                             * PDF_RENDER_FACTOR)),
-                        (int(rectangle.x2 * PDF_RENDER_FACTOR),
-                         int((pdf_size[1] - rectangle.y1)
-                             * PDF_RENDER_FACTOR)))
+        self.position = position
 
 
 class PdfPage(BasicPage):
     FILE_PREFIX = "paper."
     EXT_TXT = "txt"
     EXT_BOX = "words"
+    EXT_BOX_CACHE = "boxes"
+
+    can_render_tiles = True
 
     def __init__(self, doc, page_nb):
         BasicPage.__init__(self, doc, page_nb)
-        self.pdf_page = doc.pdf.get_page(page_nb)
-        assert(self.pdf_page is not None)
-        size = self.pdf_page.get_size()
+        pdf_page = doc.pdf.get_page(page_nb)
+        assert(pdf_page is not None)
+        size = pdf_page.get_size()
         self.size = (int(size[0]), int(size[1]))
         self.__boxes = None
 
+    def __get_pdf_page(self):
+        """
+        The Poppler page is not kept: it would keep the whole PDF file open
+        (see paperwork.backend.pdf.doc._OPEN_PDFS)
+        """
+        return self.doc.pdf.get_page(self.page_nb)
+
+    pdf_page = property(__get_pdf_page)
+
     def __get_filepath(self, ext):
         """
         Returns a file path relative to this page
@@ -82,6 +112,9 @@ class PdfPage(BasicPage):
     def __get_box_path(self):
         return self.__get_filepath(self.EXT_BOX)
 
+    def __get_box_cache_path(self):
+        return self.__get_filepath(self.EXT_BOX_CACHE)
+
     def __get_last_mod(self):
         try:
             return os.stat(self.__get_txt_path()).st_mtime
@@ -111,6 +144,78 @@ class PdfPage(BasicPage):
             txt = unicode(txt, encoding='utf-8')
             return txt.split(u"\n")
 
+    def __get_boxes_from_layout(self):
+        """
+        Build the word boxes and the line boxes in a single pass, using the
+        position of each character of the page text.
+
+        Returns:
+            The line boxes. None if Poppler can't give us the position of the
+            characters.
+        """
+        pdf_page = self.pdf_page
+        if not hasattr(pdf_page, "get_text_layout"):
+            # Poppler < 0.16
+            return None
+        txt = unicode(pdf_page.get_text(), encoding='utf-8')
+        layout = pdf_page.get_text_layout()
+        # depending on the version of PyGObject, we may or may not get the
+        # boolean returned by poppler_page_get_text_layout()
+        if (isinstance(layout, tuple) and len(layout) == 2
+                and isinstance(layout[0], bool)):
+            (has_layout, layout) = layout
+            if not has_layout:
+                return None
+        if layout is None or len(layout) != len(txt):
+            return None
+
+        line_boxes = []
+        word_boxes = []
+        word = []
+        word_positions = []
+        # the final line break flushes the last word and the last line
+        for (char, rect) in zip(txt, layout) + [(u"\n", None)]:
+            if not char.isspace():
+                word.append(char)
+                word_positions.append(_get_position(rect.x1, rect.y1,
+                                                    rect.x2, rect.y2))
+                continue
+            if len(word) > 0:
+                word_boxes.append(PdfWordBox(
+                    u"".join(word), _get_bounding_position(word_positions)))
+                word = []
+                word_positions = []
+            if char == u"\n" and len(word_boxes) > 0:
+                line_boxes.append(PdfLineBox(
+                    word_boxes, _get_bounding_position(
+                        [box.position for box in word_boxes])))
+                word_boxes = []
+        return line_boxes
+
+    def __get_boxes_from_search(self):
+        """
+        Slow fallback: look for each word of the page text with
+        Poppler.Page.find_text(). We get one line box per word.
+        """
+        pdf_page = self.pdf_page
+        txt = pdf_page.get_text()
+        pdf_size = pdf_page.get_size()
+        words = set()
+        boxes = []
+        for line in txt.split("\n"):
+            for word in split_words(unicode(line, encoding='utf-8')):
+                words.add(word)
+        for word in words:
+            for rect in pdf_page.find_text(word):
+                # XXX(Jflesch): Coordinates seem to come from the bottom left
+                # of the page instead of the top left !?
+                position = _get_position(rect.x1, pdf_size[1] - rect.y2,
+                                         rect.x2, pdf_size[1] - rect.y1)
+                word_box = PdfWordBox(word, position)
+                line_box = PdfLineBox([word_box], position)
+                boxes.append(line_box)
+        return boxes
+
     def __get_boxes(self):
         """
         Get all the word boxes of this page.
@@ -123,11 +228,9 @@ class PdfPage(BasicPage):
         try:
             os.stat(boxfile)
 
-            box_builder = pyocr.builders.LineBoxBuilder()
-
             try:
-                with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
-                    self.__boxes = box_builder.read_file(file_desc)
+                self.__boxes = boxcache.read_boxes(
+                    boxfile, self.__get_box_cache_path())
                 return self.__boxes
             except IOError, exc:
                 print ("Unable to get boxes for '%s': %s"
@@ -137,21 +240,15 @@ class PdfPage(BasicPage):
             pass
 
         # fall back on what libpoppler tells us
-
-        # TODO: Line support !
-
-        txt = self.pdf_page.get_text()
-        pdf_size = self.pdf_page.get_size()
-        words = set()
-        self.__boxes = []
-        for line in txt.split("\n"):
-            for word in split_words(unicode(line, encoding='utf-8')):
-                words.add(word)
-        for word in words:
-            for rect in self.pdf_page.find_text(word):
-                word_box = PdfWordBox(word, rect, pdf_size)
-                line_box = PdfLineBox([word_box], rect, pdf_size)
-                self.__boxes.append(line_box)
+        cache_path = self.__get_box_cache_path()
+        pdf_path = os.path.join(self.doc.path, PDF_FILENAME)
+        self.__boxes = boxcache.read_cache(cache_path, pdf_path)
+        if self.__boxes is not None:
+            return self.__boxes
+        self.__boxes = self.__get_boxes_from_layout()
+        if self.__boxes is None:
+            self.__boxes = self.__get_boxes_from_search()
+        boxcache.write_cache(cache_path, pdf_path, self.__boxes)
         return self.__boxes
 
     boxes = property(__get_boxes)
@@ -164,8 +261,13 @@ class PdfPage(BasicPage):
         width = int(factor * self.size[0])
         height = int(factor * self.size[1])
 
-        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        # Pages are opaque: by painting a white background on a surface
+        # without alpha channel, we can give its content to PIL as is,
+        # without having to merge it with a background afterwards.
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
         ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
+        ctx.paint()
         ctx.scale(factor, factor)
         self.pdf_page.render(ctx)
         return surface2image(surface)
@@ -175,6 +277,96 @@ class PdfPage(BasicPage):
 
     img = property(__get_img)
 
+    def get_zoomed_size(self, factor):
+        """
+        Size of the page image once zoomed. The factor applies to the size of
+        PdfPage.img (like for the boxes).
+        """
+        factor *= PDF_RENDER_FACTOR
+        return (int(factor * self.size[0]), int(factor * self.size[1]))
+
+    def __render_tile(self, factor, tile_x, tile_y):
+        (page_width, page_height) = self.get_zoomed_size(factor)
+        x = tile_x * TILE_SIZE
+        y = tile_y * TILE_SIZE
+        width = min(TILE_SIZE, page_width - x)
+        height = min(TILE_SIZE, page_height - y)
+
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1.0, 1.0, 1.0)
+        ctx.paint()
+        ctx.translate(-x, -y)
+        ctx.scale(factor * PDF_RENDER_FACTOR, factor * PDF_RENDER_FACTOR)
+        self.pdf_page.render(ctx)
+        return surface
+
+    def __get_tile_coords(self, factor, area):
+        """
+        Returns:
+            [(tile x, tile y), ...]: the tiles covering the area of the zoomed
+            page
+        """
+        (page_width, page_height) = self.get_zoomed_size(factor)
+        ((x1, y1), (x2, y2)) = area
+        x1 = max(0, int(x1))
+        y1 = max(0, int(y1))
+        x2 = min(page_width, int(x2) + 1)
+        y2 = min(page_height, int(y2) + 1)
+        return [(tile_x, tile_y)
+                for tile_y in xrange(y1 / TILE_SIZE,
+                                     (y2 + TILE_SIZE - 1) / TILE_SIZE)
+                for tile_x in xrange(x1 / TILE_SIZE,
+                                     (x2 + TILE_SIZE - 1) / TILE_SIZE)]
+
+    def get_tiles(self, factor, area, render=True):
+        """
+        Render only the part of the zoomed page that is actually visible.
+        Tiles are cached, so scrolling back over an area already displayed
+        doesn't require rendering it again.
+
+        Arguments:
+            factor --- zoom factor. Applies to the size of PdfPage.img (like
+                for the boxes)
+            area --- ((x1, y1), (x2, y2)): part of the zoomed page to render
+            render --- if False, the tiles not in the cache yet are not
+                rendered (see render_tile())
+
+        Returns:
+            [((x, y), cairo.ImageSurface), ...]: the tiles covering the area
+            and their position on the zoomed page. If render is False, the
+            surface of the tiles not in the cache is None.
+        """
+        tiles = []
+        for (tile_x, tile_y) in self.__get_tile_coords(factor, area):
+            key = (self.doc.docid, self.page_nb, factor, tile_x, tile_y)
+            surface = _TILE_CACHE.get(key)
+            if surface is None and render:
+                surface = self.__render_tile(factor, tile_x, tile_y)
+                _TILE_CACHE[key] = surface
+            tiles.append(((tile_x * TILE_SIZE, tile_y * TILE_SIZE),
+                          surface))
+        return tiles
+
+    def render_tile(self, factor, area):
+        """
+        Render the first tile covering the area that is not in the cache yet.
+        Allows to render the tiles one by one, out of the GUI thread.
+
+        Returns:
+            False if all the tiles covering the area are already in the cache
+        """
+        for (tile_x, tile_y) in self.__get_tile_coords(factor, area):
+            key = (self.doc.docid, self.page_nb, factor, tile_x, tile_y)
+            if key in _TILE_CACHE:
+                continue
+            _TILE_CACHE[key] = self.__render_tile(factor, tile_x, tile_y)
+            return True
+        return False
+
+    def _get_thumbnail_src_path(self):
+        return os.path.join(self.doc.path, PDF_FILENAME)
+
     def _get_thumbnail(self, width):
         factor = float(width) / self.size[0]
         return self.__render_img(factor)
@@ -208,14 +400,16 @@ class PdfPage(BasicPage):
             # in that case
             raise Exception("No OCR tool available")
 
-        txt = ocr_tools[0].image_to_string(img, lang=langs['ocr'])
+        # a single OCR pass gives us both the boxes and the text
         builder = pyocr.builders.LineBoxBuilder()
         boxes = ocr_tools[0].image_to_string(img, lang=langs['ocr'],
                                              builder=builder)
+        txt = boxes_to_text(boxes)
 
         # save the text
         with codecs.open(txtfile, 'w', encoding='utf-8') as file_desc:
             file_desc.write(txt)
         # save the boxes
-        with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
-            pyocr.builders.LineBoxBuilder.write_file(file_desc, boxes)
+        boxcache.write_boxes(boxfile, self.__get_box_cache_path(), boxes)
+        self.__boxes = None
+        self.drop_cache()
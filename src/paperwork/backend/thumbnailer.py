@@ -0,0 +1,170 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Generate page thumbnails in a pool of processes.
+
+Pages can't be sent from one process to another, so they are described using
+a tuple (docpath, docid, doctype, page number). The worker processes send
+back the thumbnails as raw RGB buffers.
+
+Only a few thumbnails are requested from the pool at a time, so the order in
+which the remaining ones are generated can be changed while they are being
+generated (for instance, to generate first the ones currently visible on
+screen).
+
+The pool is managed by an executor of its own (see OcrExecutor): jobs are
+futures, and the jobs of a worker process that died (crash in Poppler, OOM
+killer, ...) fail instead of never ending. The thumbnails don't share the
+pool of the OCR executor: they would have to wait behind long OCR jobs.
+So there may be up to 3 pools of one process per CPU at the same time (the
+thumbnailer, the OCR executor, and DocIndexUpdater while it indexes many
+documents). The processes of the first two are idle most of the time, and
+when they are all busy, the system shares the CPUs between them.
+"""
+
+import multiprocessing
+import Queue
+
+import Image
+
+from paperwork.backend.common.thumbnail import THUMBNAIL_CACHE
+from paperwork.backend.docsearch import DOC_TYPE_LIST
+from paperwork.backend.ocr import OcrExecutor
+
+
+def _make_thumbnail(page_desc, width):
+    """
+    Called in the worker processes
+
+    Returns:
+        (size, RGB data)
+    """
+    (docpath, docid, doctype, page_nb) = page_desc
+    for (is_doc_type, doc_type_name, doc_type) in DOC_TYPE_LIST:
+        if doc_type_name == doctype:
+            doc = doc_type(docpath, docid)
+            break
+    else:
+        raise ValueError("Unknown doc type for doc %s: %s"
+                         % (docid, doctype))
+    img = doc.pages[page_nb].get_thumbnail(width)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    return (img.size, img.tostring())
+
+
+def _get_distance(idx, visible_range):
+    """
+    Distance between an element of a list and the visible part of this list
+    """
+    (first, last) = visible_range
+    if idx < first:
+        return first - idx
+    if idx > last:
+        return idx - last
+    return 0
+
+
+class ThumbnailPool(object):
+    def __init__(self, nb_processes=None):
+        if nb_processes is None:
+            nb_processes = multiprocessing.cpu_count()
+        self.nb_processes = nb_processes
+        # we never have more than 2 * nb_processes jobs submitted at the
+        # same time: submitting never blocks
+        self.__executor = OcrExecutor(nb_processes, max_queued=nb_processes)
+
+    def make_thumbnails(self, pages, width,
+                        get_visible_range=lambda: None,
+                        can_run=lambda: True):
+        """
+        Generate thumbnails of the given pages. The thumbnails of the pages
+        closest to the visible range are generated first.
+
+        Arguments:
+            pages --- { index in the list: page }
+            width --- width of the thumbnails
+            get_visible_range --- callback returning the (first, last) indexes
+                currently visible. May return None.
+            can_run --- callback returning False if the generation must be
+                interrupted
+
+        Returns:
+            A generator of (index, PIL image), in the order in which the
+            thumbnails are ready. If interrupted, the indexes not returned yet
+            are simply not returned.
+        """
+        pages = dict(pages)
+        max_running = 2 * self.nb_processes
+        running = {}  # index --> (page, job)
+        done = Queue.Queue()  # (index, job), filled when the jobs are done
+        order = []
+        visible_range = -1  # we want the first get_visible_range() to differ
+
+        # thumbnails already in memory: no need to bother the pool
+        for (idx, page) in pages.items():
+            img = THUMBNAIL_CACHE.get_cached_thumbnail(page, width)
+            if img is not None:
+                pages.pop(idx)
+                yield (idx, img)
+
+        try:
+            while (len(pages) > 0 or len(running) > 0) and can_run():
+                new_visible_range = get_visible_range()
+                if new_visible_range is None:
+                    new_visible_range = (0, 0)
+                if new_visible_range != visible_range:
+                    visible_range = new_visible_range
+                    order = sorted(
+                        pages.keys(),
+                        key=lambda idx: _get_distance(idx, visible_range),
+                        reverse=True)
+
+                while len(running) < max_running and len(order) > 0:
+                    idx = order.pop()
+                    page = pages.pop(idx)
+                    page_desc = (page.doc.path, page.doc.docid,
+                                 page.doc.doctype, page.page_nb)
+                    job = self.__executor.submit(_make_thumbnail, page_desc,
+                                                 width)
+                    running[idx] = (page, job)
+                    job.add_done_callback(
+                        lambda job, idx=idx: done.put((idx, job)))
+
+                # wait for the next thumbnail (can_run() is checked between
+                # each of them). Each job ends, even if its worker process
+                # dies (see OcrExecutor).
+                (idx, job) = done.get()
+                (page, job) = running.pop(idx)
+                try:
+                    (size, data) = job.result()
+                except Exception, exc:
+                    print ("Unable to make thumbnail of %s: %s"
+                           % (str(page), str(exc)))
+                    continue
+                img = Image.fromstring("RGB", size, data)
+                THUMBNAIL_CACHE.add_thumbnail(page, width, img)
+                yield (idx, img)
+        finally:
+            for (page, job) in running.values():
+                job.cancel()
+
+    def close(self):
+        self.__executor.close()
+
+
+THUMBNAIL_POOL = ThumbnailPool()
@@ -49,6 +49,8 @@ from paperwork.backend.docsearch import DocSearch
 from paperwork.backend.docsearch import DummyDocSearch
 from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.img.page import ImgPage
+from paperwork.backend.ocr import OCR_EXECUTOR
+from paperwork.backend.thumbnailer import THUMBNAIL_POOL
 from paperwork.util import add_img_border
 from paperwork.util import ask_confirmation
 from paperwork.util import image2pixbuf
@@ -81,11 +83,6 @@ def check_scanner(main_win, config):
     return False
 
 
-def sort_documents_by_date(documents):
-    documents.sort()
-    documents.reverse()
-
-
 class WorkerDocIndexLoader(Worker):
     """
     Reload the doc index
@@ -208,6 +205,15 @@ class WorkerDocExaminer(IndependentWorker):
 GObject.type_register(WorkerDocExaminer)
 
 
+class IndexUpdateInterrupted(Exception):
+    """
+    Raised by WorkerIndexUpdater.__progress_cb() to interrupt the index
+    update. Unlike StopIteration, it can't be mistaken for the end of an
+    iteration by the loops between the callback and the worker.
+    """
+    pass
+
+
 class WorkerIndexUpdater(Worker):
     """
     Look for modified documents
@@ -227,6 +233,16 @@ class WorkerIndexUpdater(Worker):
         Worker.__init__(self, "Document index update")
         self.__main_win = main_window
         self.__config = config
+        self.__op_name = ""
+        self.__progression = 0
+        self.__total = 1
+
+    def __progress_cb(self, progression, total, step=None, doc=None):
+        if not self.can_run:
+            raise IndexUpdateInterrupted()
+        self.emit('index-update-progression',
+                  ((self.__progression + progression) * 0.75) / self.__total,
+                  "%s (%s)" % (self.__op_name, str(doc)))
 
     def do(self, new_docs=[], upd_docs=[], del_docs=[], optimize=True):
         self.emit('index-update-start')
@@ -236,26 +252,29 @@ class WorkerIndexUpdater(Worker):
 
             docs = [
                 (_("Indexing new document ..."), new_docs,
-                 index_updater.add_doc),
+                 index_updater.add_docs),
                 (_("Reindexing modified document ..."), upd_docs,
-                 index_updater.upd_doc),
-                (_("Removing deleted document from index ..."), del_docs,
-                 index_updater.del_doc),
+                 index_updater.upd_docs),
             ]
 
-            progression = float(0)
-            total = len(new_docs) + len(upd_docs) + len(del_docs)
+            self.__progression = 0
+            self.__total = len(new_docs) + len(upd_docs) + len(del_docs)
 
-            for (op_name, doc_bunch, op) in docs:
-                for doc in doc_bunch:
-                    self.emit('index-update-progression',
-                              (progression * 0.75) / total,
-                              "%s (%s)" % (op_name, str(doc)))
-                    op(doc)
-                    progression += 1
-                    if not self.can_run:
-                        index_updater.cancel()
-                        self.emit('index-update-end')
+            try:
+                for (op_name, doc_bunch, op) in docs:
+                    self.__op_name = op_name
+                    op(doc_bunch, self.__progress_cb)
+                    self.__progression += len(doc_bunch)
+
+                self.__op_name = _("Removing deleted document from index ...")
+                for docid in del_docs:
+                    self.__progress_cb(0, 1, doc=docid)
+                    index_updater.del_doc(docid)
+                    self.__progression += 1
+            except IndexUpdateInterrupted:
+                print "Index update interrupted"
+                index_updater.cancel()
+                return
 
             self.emit('index-update-progression', 0.75,
                       _("Writing index ..."))
@@ -279,6 +298,9 @@ class WorkerDocSearcher(Worker):
         # second obj: array of suggestions
         'search-result': (GObject.SignalFlags.RUN_LAST, None,
                           (GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT)),
+        # documents following those of 'search-result'
+        'search-result-more': (GObject.SignalFlags.RUN_LAST, None,
+                               (GObject.TYPE_PYOBJECT, )),
     }
 
     can_interrupt = True
@@ -287,43 +309,61 @@ class WorkerDocSearcher(Worker):
         Worker.__init__(self, "Search")
         self.__main_win = main_window
         self.__config = config
+        self.__last_sentence = u""
 
     def do(self):
-        for t in range(0, 10):
-            if not self.can_run or self.paused:
-                return
-            time.sleep(0.05)
-
         sentence = unicode(self.__main_win.search_field.get_text(),
                            encoding='utf-8')
 
+        if (self.__last_sentence == u""
+                or not sentence.startswith(self.__last_sentence)):
+            # Wait for the user to stop typing. If characters have just been
+            # appended, it's not required: the previous results will be
+            # narrowed, which is fast.
+            for t in range(0, 10):
+                if not self.can_run or self.paused:
+                    return
+                time.sleep(0.05)
+
         self.emit('search-start')
         if not self.can_run:
             return
 
-        documents = self.__main_win.docsearch.find_documents(sentence)
+        # when no specific search has been done, the sorting is always
+        # the same
+        sort = DocSearch.SORT_BY_DATE
+        if sentence != u"":
+            for (widget, sort) in self.__main_win.sortings:
+                if widget.get_active():
+                    break
+
+        # results are sorted by the index: we can display the first ones
+        # before knowing all the others
+        results = self.__main_win.docsearch.find_documents_paged(
+            sentence, as_you_type=True, sort=sort)
+        documents = results.docs
+        remaining = results.remaining()
         if not self.can_run:
             return
 
         if sentence == u"":
-            # when no specific search has been done, the sorting is always
-            # the same
-            sort_documents_by_date(documents)
             # append a new document to the list
             documents.insert(0, ImgDoc(self.__config.workdir))
-        else:
-            for (widget, sort_func) in self.__main_win.sortings:
-                if widget.get_active():
-                    sort_func(documents)
-                    break
-        if not self.can_run:
-            return
 
         suggestions = self.__main_win.docsearch.find_suggestions(sentence)
         if not self.can_run:
             return
 
         self.emit('search-result', documents, suggestions)
+        self.__last_sentence = sentence
+
+        documents = []
+        for doc in remaining:
+            if not self.can_run:
+                return
+            documents.append(doc)
+        if len(documents) > 0:
+            self.emit('search-result-more', documents)
 
 
 GObject.type_register(WorkerDocSearcher)
@@ -338,7 +378,8 @@ class WorkerPageThumbnailer(Worker):
         'page-thumbnailing-start': (GObject.SignalFlags.RUN_LAST, None, ()),
         'page-thumbnailing-page-done': (GObject.SignalFlags.RUN_LAST, None,
                                         (GObject.TYPE_INT,
-                                         GObject.TYPE_PYOBJECT)),
+                                         GObject.TYPE_PYOBJECT,
+                                         GObject.TYPE_FLOAT)),
         'page-thumbnailing-end': (GObject.SignalFlags.RUN_LAST, None, ()),
     }
 
@@ -351,13 +392,23 @@ class WorkerPageThumbnailer(Worker):
     def do(self):
         search = unicode(self.__main_win.search_field.get_text(),
                          encoding='utf-8')
+        matching_pages = set(
+            [page_nb for (docid, page_nb)
+             in self.__main_win.docsearch.find_pages(
+                 search, self.__main_win.doc.docid, as_you_type=True)])
 
         self.emit('page-thumbnailing-start')
-        for page_idx in range(0, self.__main_win.doc.nb_pages):
-            page = self.__main_win.doc.pages[page_idx]
-            img = page.get_thumbnail(WorkerDocThumbnailer.THUMB_WIDTH)
-            img = img.copy()
-            if search != u"" and search in page:
+        doc = self.__main_win.doc
+        nb_pages = doc.nb_pages
+        pages = dict([(page_idx, doc.pages[page_idx])
+                      for page_idx in range(0, nb_pages)])
+        thumbnails = THUMBNAIL_POOL.make_thumbnails(
+            pages, WorkerDocThumbnailer.THUMB_WIDTH,
+            get_visible_range=(
+                lambda: self.__main_win.lists['pages']['visible']),
+            can_run=lambda: self.can_run)
+        for (nb_done, (page_idx, img)) in enumerate(thumbnails):
+            if page_idx in matching_pages:
                 img = add_img_border(img, color="#009e00", width=3)
             else:
                 img = add_img_border(img)
@@ -365,7 +416,8 @@ class WorkerPageThumbnailer(Worker):
             if not self.can_run:
                 self.emit('page-thumbnailing-end')
                 return
-            self.emit('page-thumbnailing-page-done', page_idx, pixbuf)
+            self.emit('page-thumbnailing-page-done', page_idx, pixbuf,
+                      float(nb_done + 1) / nb_pages)
         self.emit('page-thumbnailing-end')
 
 
@@ -384,7 +436,8 @@ class WorkerDocThumbnailer(Worker):
         'doc-thumbnailing-start': (GObject.SignalFlags.RUN_LAST, None, ()),
         'doc-thumbnailing-doc-done': (GObject.SignalFlags.RUN_LAST, None,
                                       (GObject.TYPE_INT,
-                                       GObject.TYPE_PYOBJECT)),
+                                       GObject.TYPE_PYOBJECT,
+                                       GObject.TYPE_FLOAT)),
         'doc-thumbnailing-end': (GObject.SignalFlags.RUN_LAST, None, ()),
     }
 
@@ -394,36 +447,50 @@ class WorkerDocThumbnailer(Worker):
     def __init__(self, main_window):
         Worker.__init__(self, "Doc thumbnailing")
         self.__main_win = main_window
+        self.__lock = threading.Lock()
+        self.__active = False
+        self.__pending = []
 
-    def do(self, doc_indexes=None, resume=0):
-        for t in range(0, 10):
-            if not self.can_run or self.paused:
-                return resume
-            time.sleep(0.05)
-
-        self.emit('doc-thumbnailing-start')
-
-        doclist = self.__main_win.lists['matches']['doclist']
-        if doc_indexes is None:
-            if resume >= len(doclist):
-                resume = 0
-            doc_indexes = range(resume, len(doclist))
-        else:
-            if resume >= len(doc_indexes):
-                resume = 0
-            doc_indexes = doc_indexes[resume:]
+    def add_doc_indexes(self, doc_indexes):
+        """
+        Generate the thumbnails of more documents of the match list. Called
+        from the main loop: never waits for the current run to end. If the
+        worker is running, the documents are added to its pending list.
+        Otherwise, it is started.
+        """
+        with self.__lock:
+            if self.__active:
+                self.__pending += doc_indexes
+                return
+        if self.is_running:
+            # the current run is ending: try again once it's over
+            GObject.idle_add(self.add_doc_indexes, doc_indexes)
+            return
+        self.start(doc_indexes=doc_indexes)
 
+    def __make_thumbnails(self, doclist, doc_indexes):
+        """
+        Returns:
+            The indexes of the documents that have no thumbnail yet (if
+            interrupted)
+        """
+        pages = {}
         for doc_idx in doc_indexes:
-            if self.paused:
-                return resume
-            if not self.can_run:
-                self.emit('doc-thumbnailing-end')
-                return resume
+            if doc_idx >= len(doclist):
+                continue
             doc = doclist[doc_idx]
             if doc.nb_pages <= 0:
-                resume += 1
                 continue
-            img = doc.pages[0].get_thumbnail(150)
+            pages[doc_idx] = doc.pages[0]
+        remaining = set(pages.keys())
+
+        thumbnails = THUMBNAIL_POOL.make_thumbnails(
+            pages, self.THUMB_WIDTH,
+            get_visible_range=(
+                lambda: self.__main_win.lists['matches']['visible']),
+            can_run=lambda: self.can_run and not self.paused)
+        for (doc_idx, img) in thumbnails:
+            remaining.discard(doc_idx)
 
             (width, height) = img.size
             # always make sure the thumbnail has a specific height
@@ -440,10 +507,54 @@ class WorkerDocThumbnailer(Worker):
 
             img = add_img_border(img)
             pixbuf = image2pixbuf(img)
-            self.emit('doc-thumbnailing-doc-done', doc_idx, pixbuf)
-            resume += 1
+            self.emit('doc-thumbnailing-doc-done', doc_idx, pixbuf,
+                      float(len(pages) - len(remaining)) / len(pages))
+        return list(remaining)
+
+    def do(self, doc_indexes=None, resume=None):
+        """
+        Arguments:
+            doc_indexes --- indexes of the documents of the match list for
+                which a thumbnail must be generated. None means all of them.
+            resume --- if the worker was paused: what it returned (the
+                indexes of the documents that had no thumbnail yet)
+        """
+        doclist = self.__main_win.lists['matches']['doclist']
+        if resume is not None:
+            doc_indexes = resume
+        elif doc_indexes is None:
+            doc_indexes = range(0, len(doclist))
+
+        for t in range(0, 10):
+            if not self.can_run or self.paused:
+                return doc_indexes
+            time.sleep(0.05)
+
+        self.emit('doc-thumbnailing-start')
+
+        with self.__lock:
+            self.__active = True
+        try:
+            while True:
+                remaining = self.__make_thumbnails(doclist, doc_indexes)
+                with self.__lock:
+                    if (len(self.__pending) <= 0 or not self.can_run
+                            or self.paused):
+                        remaining += self.__pending
+                        self.__pending = []
+                        self.__active = False
+                        break
+                    # documents added while we were running
+                    doc_indexes = self.__pending
+                    self.__pending = []
+        finally:
+            with self.__lock:
+                self.__active = False
+
+        if self.paused and self.can_run:
+            return sorted(remaining)
         self.emit('doc-thumbnailing-end')
-        return 0
+        return None
 
 
 GObject.type_register(WorkerDocThumbnailer)
@@ -461,6 +572,14 @@ class WorkerImgBuilder(Worker):
                                         # array of boxes
                                         GObject.TYPE_PYOBJECT,
                                         )),
+        'img-building-result-tiles': (GObject.SignalFlags.RUN_LAST, None,
+                                      (GObject.TYPE_FLOAT, GObject.TYPE_INT,
+                                       GObject.TYPE_PYOBJECT,  # page size
+                                       # placeholder pixbuf
+                                       GObject.TYPE_PYOBJECT,
+                                       # array of boxes
+                                       GObject.TYPE_PYOBJECT,
+                                       )),
         'img-building-result-clear': (GObject.SignalFlags.RUN_LAST, None, ()),
         'img-building-result-stock': (GObject.SignalFlags.RUN_LAST, None,
                                       (GObject.TYPE_STRING, )),
@@ -470,14 +589,31 @@ class WorkerImgBuilder(Worker):
     # really matter
     can_interrupt = True
 
+    # Up to this zoom factor, scaling the page image is as good as rendering
+    # the page at this zoom. Above it, pages that support it are drawn by
+    # tiles.
+    MAX_SCALING_FACTOR = 1.0
+
     def __init__(self, main_window):
         Worker.__init__(self, "Building page image")
         self.__main_win = main_window
 
+    def __build_tiled(self, page, factor, original_width, pixbuf):
+        """
+        The page will be drawn by tiles, only where visible (see
+        MainWindow.__on_img_draw()). We just need the size of the zoomed
+        page. The page image is used as placeholder until the tiles are
+        rendered.
+        """
+        print "Zoom: %f (tiled)" % (factor)
+        self.emit('img-building-result-tiles', factor, original_width,
+                  page.get_zoomed_size(factor), pixbuf, page.boxes)
+
     def do(self):
         self.emit('img-building-start')
 
-        if self.__main_win.page.img is None:
+        page = self.__main_win.page
+        if page.img is None:
             self.emit('img-building-result-clear')
             return
 
@@ -497,6 +633,10 @@ class WorkerImgBuilder(Worker):
             original_width = pixbuf.get_width()
 
             factor = self.__main_win.get_zoom_factor(original_width)
+            if (page.can_render_tiles
+                    and factor > self.MAX_SCALING_FACTOR):
+                self.__build_tiled(page, factor, original_width, pixbuf)
+                return
             print "Zoom: %f" % (factor)
 
             wanted_width = int(factor * pixbuf.get_width())
@@ -514,6 +654,73 @@ class WorkerImgBuilder(Worker):
 GObject.type_register(WorkerImgBuilder)
 
 
+class WorkerTileRenderer(IndependentWorker):
+    """
+    Render the tiles of the page that are visible but not in the tile cache
+    yet (see MainWindow.__draw_tiles()), one by one, out of the GUI thread.
+
+    It has its own thread, started once and waiting for requests: the draw
+    handler must never wait for another worker.
+    """
+    __gsignals__ = {
+        'tile-rendered': (GObject.SignalFlags.RUN_LAST, None, ()),
+    }
+
+    can_interrupt = True
+
+    def __init__(self, main_window):
+        IndependentWorker.__init__(self, "Rendering tiles")
+        self.__main_win = main_window
+        self.__cond = threading.Condition()
+        self.__wanted = None  # (page, factor, area)
+
+    def render(self, page, factor, area):
+        """
+        Called from the main loop. Replaces any previous request: only the
+        tiles currently visible matter. Never blocks.
+        """
+        with self.__cond:
+            self.__wanted = (page, factor, area)
+            self.__cond.notify_all()
+
+    def cancel(self):
+        """
+        Forget the current request (for instance, when another page is
+        displayed)
+        """
+        with self.__cond:
+            self.__wanted = None
+
+    def soft_stop(self):
+        IndependentWorker.soft_stop(self)
+        with self.__cond:
+            self.__cond.notify_all()
+
+    def do(self):
+        while True:
+            with self.__cond:
+                while self.can_run and self.__wanted is None:
+                    self.__cond.wait()
+                if not self.can_run:
+                    return
+                wanted = self.__wanted
+            (page, factor, area) = wanted
+            try:
+                if page.render_tile(factor, area):
+                    self.emit('tile-rendered')
+                    continue
+            except Exception, exc:
+                print "Unable to render a tile of %s: %s" % (str(page),
+                                                             str(exc))
+            with self.__cond:
+                if self.__wanted is wanted:
+                    # nothing else has been requested meanwhile
+                    self.__wanted = None
+
+
+GObject.type_register(WorkerTileRenderer)
+
+
 class WorkerLabelUpdater(Worker):
     """
     Resize and paint on the page
@@ -581,6 +788,14 @@ class WorkerLabelDeleter(Worker):
 GObject.type_register(WorkerLabelDeleter)
 
 
+class OCRRedoInterrupted(Exception):
+    """
+    Raised by WorkerOCRRedoer.__progress_cb() to interrupt the OCR: the pages
+    not started yet are then cancelled (see OcrExecutor.redo_ocr())
+    """
+    pass
+
+
 class WorkerOCRRedoer(Worker):
     """
     Resize and paint on the page
@@ -592,7 +807,7 @@ class WorkerOCRRedoer(Worker):
         'redo-ocr-end': (GObject.SignalFlags.RUN_LAST, None, ()),
     }
 
-    can_interrupt = False
+    can_interrupt = True
 
     def __init__(self, main_window, config):
         Worker.__init__(self, "Redoing OCR")
@@ -600,6 +815,10 @@ class WorkerOCRRedoer(Worker):
         self.__config = config
 
     def __progress_cb(self, progression, total, step, doc):
+        if not self.can_run:
+            raise OCRRedoInterrupted()
+        if total <= 0:
+            return
         self.emit('redo-ocr-doc-updated', float(progression) / total,
                   doc.name)
 
@@ -607,6 +826,8 @@ class WorkerOCRRedoer(Worker):
         self.emit('redo-ocr-start')
         try:
             doc_target.redo_ocr(self.__config.langs, self.__progress_cb)
+        except OCRRedoInterrupted:
+            print "OCR redo interrupted"
         finally:
             self.emit('redo-ocr-end')
 
@@ -687,6 +908,8 @@ class WorkerImporter(Worker):
         (doc, page) = importer.import_doc(file_uri, self.__config,
                                           self.__main_win.docsearch,
                                           self.__main_win.doc)
+        # make the new document searchable right now
+        self.__main_win.docsearch.flush_index()
         self.emit('import-done', doc, page)
 
 
@@ -1241,7 +1464,9 @@ class ActionDeleteDoc(SimpleAction):
             return
         SimpleAction.do(self)
         print "Deleting ..."
+        docid = self.__main_win.doc.docid
         self.__main_win.doc.destroy()
+        self.__main_win.docsearch.unindex_doc(docid)
         print "Deleted"
         self.__main_win.actions['new_doc'][1].do()
         self.__main_win.actions['reindex'][1].do()
@@ -1276,12 +1501,13 @@ class ActionRedoDocOCR(SimpleAction):
         self.__main_win = main_window
 
     def do(self):
+        if self.__main_win.workers['ocr_redoer'].is_running:
+            # clicking again interrupts it
+            self.__main_win.workers['ocr_redoer'].soft_stop()
+            return
         if not ask_confirmation(self.__main_win.window):
             return
         SimpleAction.do(self)
-
-        if self.__main_win.workers['ocr_redoer'].is_running:
-            return
         doc = self.__main_win.doc
         self.__main_win.workers['ocr_redoer'].start(doc_target=doc)
 
@@ -1292,12 +1518,13 @@ class ActionRedoAllOCR(SimpleAction):
         self.__main_win = main_window
 
     def do(self):
+        if self.__main_win.workers['ocr_redoer'].is_running:
+            # clicking again interrupts it
+            self.__main_win.workers['ocr_redoer'].soft_stop()
+            return
         if not ask_confirmation(self.__main_win.window):
             return
         SimpleAction.do(self)
-
-        if self.__main_win.workers['ocr_redoer'].is_running:
-            return
         doc = self.__main_win.docsearch
         self.__main_win.workers['ocr_redoer'].start(doc_target=doc)
 
@@ -1647,6 +1874,9 @@ class ActionRealQuit(SimpleAction):
         for worker in self.__main_win.workers.values():
             worker.stop()
 
+        THUMBNAIL_POOL.close()
+        OCR_EXECUTOR.close()
+        self.__main_win.docsearch.flush_index()
         self.__config.write()
         Gtk.main_quit()
 
@@ -1768,10 +1998,12 @@ class MainWindow(object):
                 'model': widget_tree.get_object("liststoreMatch"),
                 'doclist': [],
                 'active_idx': -1,
+                'visible': None,  # (first index, last index)
             },
             'pages': {
                 'gui': widget_tree.get_object("iconviewPage"),
                 'model': widget_tree.get_object("liststorePage"),
+                'visible': None,  # (first index, last index)
             },
             'labels': {
                 'gui': widget_tree.get_object("treeviewLabel"),
@@ -1814,6 +2046,11 @@ class MainWindow(object):
             },
             "eventbox": widget_tree.get_object("eventboxImg"),
             "pixbuf": None,
+            "size": (0, 0),
+            # True if the page is drawn by tiles (see __on_img_draw())
+            "tiled": False,
+            # page image displayed while the tiles are rendered
+            "placeholder": None,
             "factor": 1.0,
             "original_width": 1,
             "boxes": {
@@ -1892,9 +2129,9 @@ class MainWindow(object):
 
         self.sortings = [
             (widget_tree.get_object("radiomenuitemSortByRelevance"),
-             lambda docs: None),
+             DocSearch.SORT_BY_RELEVANCE),
             (widget_tree.get_object("radiomenuitemSortByScanDate"),
-             sort_documents_by_date),
+             DocSearch.SORT_BY_DATE),
         ]
 
         self.workers = {
@@ -1905,6 +2142,7 @@ class MainWindow(object):
             'page_thumbnailer': WorkerPageThumbnailer(self),
             'doc_thumbnailer': WorkerDocThumbnailer(self),
             'img_builder': WorkerImgBuilder(self),
+            'tile_renderer': WorkerTileRenderer(self),
             'label_updater': WorkerLabelUpdater(self),
             'label_deleter': WorkerLabelDeleter(self),
             'single_scan': WorkerSingleScan(self, config),
@@ -2296,6 +2534,15 @@ class MainWindow(object):
         self.lists['matches']['gui'].connect(
             "drag-data-received", self.__on_match_list_drag_data_received_cb)
 
+        # the thumbnailers generate first the thumbnails currently visible
+        for list_name in ['matches', 'pages']:
+            vadjustment = self.lists[list_name]['gui'].get_vadjustment()
+            for signal in ['value-changed', 'changed']:
+                vadjustment.connect(
+                    signal,
+                    lambda adjustment, list_name=list_name:
+                    self.__update_visible_range(list_name))
+
         self.window.connect("destroy",
                             ActionRealQuit(self, config).on_window_close_cb)
 
@@ -2344,6 +2591,10 @@ class MainWindow(object):
             lambda searcher, documents, suggestions:
             GObject.idle_add(self.__on_search_result_cb, documents,
                              suggestions))
+        self.workers['searcher'].connect(
+            'search-result-more',
+            lambda searcher, documents:
+            GObject.idle_add(self.__on_search_result_more_cb, documents))
 
         self.workers['page_thumbnailer'].connect(
             'page-thumbnailing-start',
@@ -2352,9 +2603,9 @@ class MainWindow(object):
                              thumbnailer))
         self.workers['page_thumbnailer'].connect(
             'page-thumbnailing-page-done',
-            lambda thumbnailer, page_idx, thumbnail:
+            lambda thumbnailer, page_idx, thumbnail, progression:
             GObject.idle_add(self.__on_page_thumbnailing_page_done_cb,
-                             thumbnailer, page_idx, thumbnail))
+                             thumbnailer, page_idx, thumbnail, progression))
         self.workers['page_thumbnailer'].connect(
             'page-thumbnailing-end',
             lambda thumbnailer:
@@ -2368,9 +2619,9 @@ class MainWindow(object):
                              thumbnailer))
         self.workers['doc_thumbnailer'].connect(
             'doc-thumbnailing-doc-done',
-            lambda thumbnailer, doc_idx, thumbnail:
+            lambda thumbnailer, doc_idx, thumbnail, progression:
             GObject.idle_add(self.__on_doc_thumbnailing_doc_done_cb,
-                             thumbnailer, doc_idx, thumbnail))
+                             thumbnailer, doc_idx, thumbnail, progression))
         self.workers['doc_thumbnailer'].connect(
             'doc-thumbnailing-end',
             lambda thumbnailer:
@@ -2386,6 +2637,12 @@ class MainWindow(object):
             lambda builder, factor, original_width, img, boxes:
             GObject.idle_add(self.__on_img_building_result_pixbuf,
                              builder, factor, original_width, img, boxes))
+        self.workers['img_builder'].connect(
+            'img-building-result-tiles',
+            lambda builder, factor, original_width, size, placeholder, boxes:
+            GObject.idle_add(self.__on_img_building_result_tiles,
+                             builder, factor, original_width, size,
+                             placeholder, boxes))
         self.workers['img_builder'].connect(
             'img-building-result-stock',
             lambda builder, img:
@@ -2394,6 +2651,12 @@ class MainWindow(object):
             'img-building-result-clear',
             lambda builder:
             GObject.idle_add(self.__on_img_building_result_clear))
+        self.workers['tile_renderer'].connect(
+            'tile-rendered',
+            lambda renderer:
+            GObject.idle_add(self.__on_tile_rendered))
+        # waits for requests from __draw_tiles() until we quit
+        self.workers['tile_renderer'].start()
 
         self.workers['label_updater'].connect(
             'label-updating-start',
@@ -2591,15 +2854,36 @@ class MainWindow(object):
         self.workers['page_thumbnailer'].start()
         self.workers['doc_thumbnailer'].start()
 
+    def __on_search_result_more_cb(self, documents):
+        print "Got %d more documents" % len(documents)
+
+        doclist = self.lists['matches']['doclist']
+        active_idx = self.lists['matches']['active_idx']
+        first_new_idx = len(doclist)
+        for doc in documents:
+            if active_idx < 0 and doc == self.doc:
+                active_idx = len(doclist)
+            doclist.append(doc)
+            self.lists['matches']['model'].append(
+                self.__get_doc_model_line(doc))
+
+        if active_idx != self.lists['matches']['active_idx']:
+            self.lists['matches']['active_idx'] = active_idx
+            self.__select_doc(active_idx)
+
+        # the doc thumbnailer may still be working on the first documents
+        self.workers['doc_thumbnailer'].add_doc_indexes(
+            range(first_new_idx, len(doclist)))
+
     def __on_page_thumbnailing_start_cb(self, src):
         self.set_progression(src, 0.0, _("Loading thumbnails ..."))
         self.set_mouse_cursor("Busy")
 
-    def __on_page_thumbnailing_page_done_cb(self, src, page_idx, thumbnail):
+    def __on_page_thumbnailing_page_done_cb(self, src, page_idx, thumbnail,
+                                            progression):
         line_iter = self.lists['pages']['model'].get_iter(page_idx)
         self.lists['pages']['model'].set_value(line_iter, 0, thumbnail)
-        self.set_progression(src, ((float)(page_idx+1) / self.doc.nb_pages),
-                             _("Loading thumbnails ..."))
+        self.set_progression(src, progression, _("Loading thumbnails ..."))
 
     def __on_page_thumbnailing_end_cb(self, src):
         self.set_progression(src, 0.0, None)
@@ -2608,33 +2892,68 @@ class MainWindow(object):
     def __on_doc_thumbnailing_start_cb(self, src):
         self.set_progression(src, 0.0, _("Loading thumbnails ..."))
 
-    def __on_doc_thumbnailing_doc_done_cb(self, src, doc_idx, thumbnail):
+    def __on_doc_thumbnailing_doc_done_cb(self, src, doc_idx, thumbnail,
+                                          progression):
         line_iter = self.lists['matches']['model'].get_iter(doc_idx)
         self.lists['matches']['model'].set_value(line_iter, 2, thumbnail)
-        self.set_progression(src, ((float)(doc_idx+1) /
-                                   len(self.lists['matches']['doclist'])),
-                             _("Loading thumbnails ..."))
+        self.set_progression(src, progression, _("Loading thumbnails ..."))
         active_doc_idx = self.lists['matches']['active_idx']
 
     def __on_doc_thumbnailing_end_cb(self, src):
         self.set_progression(src, 0.0, None)
 
+    def __update_visible_range(self, list_name):
+        """
+        Keep track of the elements currently visible in the doc list or
+        the page list. Used by the thumbnailers.
+        """
+        visible = self.lists[list_name]['gui'].get_visible_range()
+        # depending on the version of PyGObject, we may or may not get the
+        # boolean returned by gtk_icon_view_get_visible_range()
+        if not visible or not visible[0]:
+            self.lists[list_name]['visible'] = None
+            return
+        (first_path, last_path) = visible[-2:]
+        self.lists[list_name]['visible'] = (first_path.get_indices()[0],
+                                            last_path.get_indices()[0])
+
     def disable_boxes(self):
         self.img['boxes']['all'] = []
         self.img['boxes']['highlighted'] = []
         self.img['boxes']['visible'] = []
 
+    def __set_img_tiled(self, size=None, placeholder=None):
+        """
+        Switch the page image between normal mode (size=None: the image
+        widget displays a pixbuf) and tiled mode (the visible tiles are drawn
+        on the image widget, see __on_img_draw())
+        """
+        if size is None:
+            self.img['tiled'] = False
+            self.img['placeholder'] = None
+            self.img['image'].set_size_request(-1, -1)
+            return
+        self.img['tiled'] = True
+        self.img['placeholder'] = placeholder
+        self.img['pixbuf'] = None
+        self.img['size'] = size
+        self.img['image'].clear()
+        self.img['image'].set_size_request(size[0], size[1])
+
     def __on_img_building_start(self):
         self.disable_boxes()
         self.set_mouse_cursor("Busy")
+        self.__set_img_tiled(None)
         self.img['image'].set_from_stock(Gtk.STOCK_EXECUTE,
                                          Gtk.IconSize.DIALOG)
 
     def __on_img_building_result_stock(self, img):
+        self.__set_img_tiled(None)
         self.img['image'].set_from_stock(img, Gtk.IconSize.DIALOG)
         self.set_mouse_cursor("Normal")
 
     def __on_img_building_result_clear(self):
+        self.__set_img_tiled(None)
         self.img['image'].clear()
         self.set_mouse_cursor("Normal")
 
@@ -2645,11 +2964,29 @@ class MainWindow(object):
 
         self.img['factor'] = factor
         self.img['pixbuf'] = pixbuf
+        self.img['size'] = (pixbuf.get_width(), pixbuf.get_height())
         self.img['original_width'] = original_width
 
+        self.__set_img_tiled(None)
         self.img['image'].set_from_pixbuf(pixbuf)
         self.set_mouse_cursor("Normal")
 
+    def __on_img_building_result_tiles(self, builder, factor, original_width,
+                                       size, placeholder, boxes):
+        self.img['boxes']['all'] = boxes
+        self.__reload_boxes()
+
+        self.img['factor'] = factor
+        self.img['original_width'] = original_width
+
+        self.__set_img_tiled(size, placeholder)
+        self.img['image'].queue_draw()
+        self.set_mouse_cursor("Normal")
+
+    def __on_tile_rendered(self):
+        if self.img['tiled']:
+            self.img['image'].queue_draw()
+
     def __on_label_updating_start_cb(self, src):
         self.set_search_availability(False)
         self.set_mouse_cursor("Busy")
@@ -2682,6 +3019,8 @@ class MainWindow(object):
         self.set_search_availability(True)
         self.set_mouse_cursor("Normal")
         self.refresh_label_list()
+        # the OCR has been redone in other processes
+        self.page.drop_cache()
         # in case the keywords were highlighted
         self.show_page(self.page)
         self.actions['reindex'][1].do()
@@ -2838,8 +3177,7 @@ class MainWindow(object):
         if window:
             (win_w, win_h) = (window.get_allocation().width,
                               window.get_allocation().height)
-            (pic_w, pic_h) = (self.img['pixbuf'].get_width(),
-                              self.img['pixbuf'].get_height())
+            (pic_w, pic_h) = self.img['size']
             (margin_x, margin_y) = ((win_w-pic_w)/2, (win_h-pic_h)/2)
             a += margin_x
             b += margin_y
@@ -2851,7 +3189,47 @@ class MainWindow(object):
         d += width
         return ((int(a), int(b)), (int(c), int(d)))
 
+    def __draw_tiles(self, imgwidget, cairo_context):
+        """
+        Draw the tiles of the page that are in the area to redraw
+        """
+        (win_w, win_h) = (imgwidget.get_allocation().width,
+                          imgwidget.get_allocation().height)
+        (pic_w, pic_h) = self.img['size']
+        (margin_x, margin_y) = ((win_w-pic_w)/2, (win_h-pic_h)/2)
+
+        (x1, y1, x2, y2) = cairo_context.clip_extents()
+        area = ((x1 - margin_x, y1 - margin_y),
+                (x2 - margin_x, y2 - margin_y))
+        factor = self.img['factor']
+        # tiles not in the cache yet are rendered by the tile renderer: the
+        # page image is scaled and drawn instead meanwhile
+        tiles = self.page.get_tiles(factor, area, render=False)
+        missing = [pos for (pos, tile) in tiles if tile is None]
+        placeholder = self.img['placeholder']
+        if len(missing) > 0 and placeholder is not None:
+            cairo_context.save()
+            cairo_context.translate(margin_x, margin_y)
+            cairo_context.scale(float(pic_w) / placeholder.get_width(),
+                                float(pic_h) / placeholder.get_height())
+            Gdk.cairo_set_source_pixbuf(cairo_context, placeholder, 0, 0)
+            cairo_context.paint()
+            cairo_context.restore()
+        if len(missing) > 0:
+            self.workers['tile_renderer'].render(self.page, factor, area)
+
+        for ((x, y), tile) in tiles:
+            if tile is None:
+                continue
+            cairo_context.set_source_surface(tile, x + margin_x, y + margin_y)
+            cairo_context.rectangle(x + margin_x, y + margin_y,
+                                    tile.get_width(), tile.get_height())
+            cairo_context.fill()
+
     def __on_img_draw(self, imgwidget, cairo_context):
+        if self.img['tiled'] and self.page.can_render_tiles:
+            self.__draw_tiles(imgwidget, cairo_context)
+
         visible = []
         for line in self.img['boxes']['visible']:
             visible += line.word_boxes
@@ -3091,6 +3469,8 @@ class MainWindow(object):
         print "Showing page %s" % (str(page))
 
         self.workers['img_builder'].stop()
+        # tiles of the previous page aren't wanted anymore
+        self.workers['tile_renderer'].cancel()
 
         if self.export['exporter'] is not None:
             print "Canceling export"
@@ -3138,7 +3518,15 @@ class MainWindow(object):
         self.refresh_page_list()
         self.refresh_label_list()
         if self.doc.nb_pages > 0:
-            self.show_page(self.doc.pages[0])
+            # jump to the first page matching the search, if any
+            search = unicode(self.search_field.get_text(), encoding='utf-8')
+            matching_pages = self.docsearch.find_pages(search, self.doc.docid,
+                                                       as_you_type=True)
+            page_nb = 0
+            if (len(matching_pages) > 0
+                    and matching_pages[0][1] < self.doc.nb_pages):
+                page_nb = matching_pages[0][1]
+            self.show_page(self.doc.pages[page_nb])
         else:
             self.img['image'].set_from_stock(Gtk.STOCK_MISSING_IMAGE,
                                              Gtk.IconSize.DIALOG)
@@ -3148,6 +3536,7 @@ class MainWindow(object):
 
     def __on_export_preview_done(self, img_size, pixbuf):
         self.export['estimated_size'].set_text(sizeof_fmt(img_size))
+        self.__set_img_tiled(None)
         self.img['image'].set_from_pixbuf(pixbuf)
 
     def __get_img_area_width(self):
@@ -31,6 +31,7 @@ import pyinsane.abstract_th  # Just to start the Sane thread
 from frontend import mainwindow
 from frontend import workers
 from backend.config import PaperworkConfig
+from backend.pdf.doc import set_max_open_pdfs
 
 
 LOCALE_PATHS = [
@@ -93,6 +94,7 @@ def main():
     try:
         config = PaperworkConfig()
         config.read()
+        set_max_open_pdfs(config.max_open_pdfs)
 
         main_win = mainwindow.MainWindow(config)
         mainwindow.ActionRebuildIndex(main_win, config).do()
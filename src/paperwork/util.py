@@ -17,10 +17,12 @@
 Various tiny functions that didn't fit anywhere else.
 """
 
+import collections
 import errno
 import os
 import re
 import StringIO
+import sys
 import threading
 import unicodedata
 
@@ -113,6 +115,26 @@ def split_words(sentence):
             yield word
 
 
+def boxes_to_text(boxes):
+    """
+    Rebuild the text of a page from its line boxes (see pyocr.builders).
+    One line of text per line box.
+
+    Returns:
+        An unicode string
+    """
+    lines = []
+    for line in boxes:
+        words = []
+        for word in line.word_boxes:
+            content = word.content
+            if not isinstance(content, unicode):
+                content = content.decode('utf-8')
+            words.append(content)
+        lines.append(u" ".join(words))
+    return u"\n".join(lines)
+
+
 def load_uifile(filename):
     """
     Load a .glade file and return the corresponding widget tree
@@ -146,17 +168,36 @@ def load_uifile(filename):
     return widget_tree
 
 
+# Cairo stores the pixels as native-endian 32bits integers (0xXXRRGGBB)
+if sys.byteorder == "little":
+    _CAIRO_RAW_MODE = "BGRX"
+    _CAIRO_RAW_MODE_ALPHA = "BGRA"
+else:
+    _CAIRO_RAW_MODE = "XRGB"
+    _CAIRO_RAW_MODE_ALPHA = "ARGB"
+
+
 def image2surface(img):
     """
     Convert a PIL image into a Cairo surface
     """
     if img is None:
         return None
-    file_desc = StringIO.StringIO()
-    img.save(file_desc, format="PNG")
-    file_desc.seek(0)
-    surface = cairo.ImageSurface.create_from_png(file_desc)
-    return surface
+    if img.mode in ("RGBA", "LA", "P"):
+        # Cairo expects premultiplied alpha: let it do the conversion
+        file_desc = StringIO.StringIO()
+        img.save(file_desc, format="PNG")
+        file_desc.seek(0)
+        surface = cairo.ImageSurface.create_from_png(file_desc)
+        return surface
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    (width, height) = img.size
+    # Cairo requires a writable buffer. The surface keeps a reference on it,
+    # so the pixels are not copied again.
+    data = bytearray(img.tostring("raw", _CAIRO_RAW_MODE))
+    return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_RGB24,
+                                              width, height, width * 4)
 
 
 def surface2image(surface):
@@ -165,21 +206,24 @@ def surface2image(surface):
     """
     if surface is None:
         return None
+    surface.flush()
     dimension = (surface.get_width(), surface.get_height())
-    img = Image.frombuffer("RGBA", dimension,
-                           surface.get_data(), "raw", "BGRA", 0, 1)
+    if surface.get_format() == cairo.FORMAT_RGB24:
+        return Image.frombuffer("RGB", dimension, surface.get_data(), "raw",
+                                _CAIRO_RAW_MODE, surface.get_stride(), 1)
 
+    img = Image.frombuffer("RGBA", dimension, surface.get_data(), "raw",
+                           _CAIRO_RAW_MODE_ALPHA, surface.get_stride(), 1)
     background = Image.new("RGB", img.size, (255, 255, 255))
     background.paste(img, mask=img.split()[3])  # 3 is the alpha channel
     return background
 
 
-def image2pixbuf(img):
+def _image2pixbuf_pnm(img):
     """
-    Convert an image object to a gdk pixbuf
+    Convert an image object to a gdk pixbuf by going through the PNM format.
+    Slow, but works with any version of GdkPixbuf.
     """
-    if img is None:
-        return None
     file_desc = StringIO.StringIO()
     try:
         img.save(file_desc, "ppm")
@@ -195,6 +239,26 @@ def image2pixbuf(img):
     return pixbuf
 
 
+def image2pixbuf(img):
+    """
+    Convert an image object to a gdk pixbuf
+    """
+    if img is None:
+        return None
+    if not hasattr(GdkPixbuf.Pixbuf, "new_from_bytes"):
+        # GdkPixbuf < 2.32
+        return _image2pixbuf_pnm(img)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    has_alpha = (img.mode == "RGBA")
+    (width, height) = img.size
+    rowstride = width * (4 if has_alpha else 3)
+    data = GLib.Bytes.new(img.tostring())
+    return GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB,
+                                           has_alpha, 8, width, height,
+                                           rowstride)
+
+
 def dummy_progress_cb(progression, total, step=None, doc=None):
     """
     Dummy progression callback. Do nothing.
@@ -274,69 +338,110 @@ def add_img_border(img, color="#a6a5a4", width=1):
     return img
 
 
-_ENCHANT_LOCK = threading.Lock()
 _MAX_LEVENSHTEIN_DISTANCE = 1
 _MIN_WORD_LEN = 4
+_SPELLING_MEMO_SIZE = 8192
 
+# enchant dictionaries are not thread-safe: each thread (and each process)
+# gets its own
+_SPELLING_TOOLS = threading.local()
+# spelling_lang --> LRUCache: word --> (score, replacement or None)
+_SPELLING_MEMOS = {}
 
-def check_spelling(spelling_lang, txt):
-    """
-    Check the spelling in the text, and compute a score. The score is the
-    number of words correctly (or almost correctly) spelled, minus the number
-    of mispelled words. Words "almost" correct remains neutral (-> are not
-    included in the score)
 
+def _get_spelling_tools(spelling_lang):
+    """
     Returns:
-        A tuple : (fixed text, score)
+        (enchant dictionary, tokenizer) for the current thread
     """
-    _ENCHANT_LOCK.acquire()
-    try:
-        # Maximum distance from the first suggestion from python-enchant
-
+    if getattr(_SPELLING_TOOLS, 'pid', None) != os.getpid():
+        # new thread, or forked process
+        _SPELLING_TOOLS.pid = os.getpid()
+        _SPELLING_TOOLS.tools = {}
+    tools = _SPELLING_TOOLS.tools
+    if spelling_lang not in tools:
         words_dict = enchant.request_dict(spelling_lang)
         try:
             tknzr = enchant.tokenize.get_tokenizer(spelling_lang)
         except enchant.tokenize.TokenizerNotFoundError:
             # Fall back to default tokenization if no match for 'lang'
             tknzr = enchant.tokenize.get_tokenizer()
+        tools[spelling_lang] = (words_dict, tknzr)
+    return tools[spelling_lang]
 
-        score = 0
-        offset = 0
-        for (word, word_pos) in tknzr(txt):
-            if len(word) < _MIN_WORD_LEN:
-                continue
-            if words_dict.check(word):
-                # immediately correct words are a really good hint for
-                # orientation
-                score += 100
-                continue
-            suggestions = words_dict.suggest(word)
-            if (len(suggestions) <= 0):
-                # this word is useless. It may even indicates a bad orientation
-                score -= 10
-                continue
-            main_suggestion = suggestions[0]
-            lv_dist = Levenshtein.distance(word, main_suggestion)
-            if (lv_dist > _MAX_LEVENSHTEIN_DISTANCE):
-                # hm, this word looks like it's in a bad shape
-                continue
 
-            print ("Spell checking: Replacing: %s -> %s"
-                   % (word, main_suggestion))
+def _get_spelling_memo(spelling_lang):
+    memo = _SPELLING_MEMOS.get(spelling_lang)
+    if memo is None:
+        memo = _SPELLING_MEMOS.setdefault(spelling_lang,
+                                          LRUCache(_SPELLING_MEMO_SIZE))
+    return memo
 
-            # let's replace the word by its suggestion
 
-            pre_txt = txt[:word_pos + offset]
-            post_txt = txt[word_pos + len(word) + offset:]
-            txt = pre_txt + main_suggestion + post_txt
-            offset += (len(main_suggestion) - len(word))
+def _check_word(words_dict, word):
+    """
+    Returns:
+        (score of the word, replacement for the word or None)
+    """
+    if words_dict.check(word):
+        # immediately correct words are a really good hint for
+        # orientation
+        return (100, None)
+    suggestions = words_dict.suggest(word)
+    if (len(suggestions) <= 0):
+        # this word is useless. It may even indicates a bad orientation
+        return (-10, None)
+    main_suggestion = suggestions[0]
+    lv_dist = Levenshtein.distance(word, main_suggestion)
+    if (lv_dist > _MAX_LEVENSHTEIN_DISTANCE):
+        # hm, this word looks like it's in a bad shape
+        return (0, None)
+    # fixed words may be a good hint for orientation
+    return (5, main_suggestion)
 
-            # fixed words may be a good hint for orientation
-            score += 5
 
-        return (txt, score)
-    finally:
-        _ENCHANT_LOCK.release()
+def check_spelling(spelling_lang, txt):
+    """
+    Check the spelling in the text, and compute a score. The score is the
+    number of words correctly (or almost correctly) spelled, minus the number
+    of mispelled words. Words "almost" correct remains neutral (-> are not
+    included in the score)
+
+    Words already checked recently (by any thread of the process) are not
+    checked again: OCR tools tend to output the same garbage again and
+    again, and looking for suggestions is slow.
+
+    Returns:
+        A tuple : (fixed text, score)
+    """
+    (words_dict, tknzr) = _get_spelling_tools(spelling_lang)
+    memo = _get_spelling_memo(spelling_lang)
+
+    score = 0
+    offset = 0
+    for (word, word_pos) in tknzr(txt):
+        if len(word) < _MIN_WORD_LEN:
+            continue
+        word_check = memo.get(word)
+        if word_check is None:
+            word_check = _check_word(words_dict, word)
+            memo[word] = word_check
+        (word_score, replacement) = word_check
+        score += word_score
+        if replacement is None:
+            continue
+
+        print ("Spell checking: Replacing: %s -> %s"
+               % (word, replacement))
+
+        # let's replace the word by its suggestion
+
+        pre_txt = txt[:word_pos + offset]
+        post_txt = txt[word_pos + len(word) + offset:]
+        txt = pre_txt + replacement + post_txt
+        offset += (len(replacement) - len(word))
+
+    return (txt, score)
 
 
 def mkdir_p(path):
@@ -369,3 +474,69 @@ def rm_rf(path):
                 print "Deleting dir %s" % dirpath
                 os.rmdir(dirpath)
         os.rmdir(path)
+
+
+class LRUCache(object):
+    """
+    Thread-safe dictionary-like cache. It keeps at most 'max_size' elements:
+    when a new one is added, the least recently used one is dropped.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.__lock = threading.Lock()
+        self.__content = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        with self.__lock:
+            value = self.__content.pop(key)
+            self.__content[key] = value
+            return value
+
+    def get(self, key, default=None):
+        """
+        Returns the value associated to the key, or 'default' if there is none
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        with self.__lock:
+            self.__content.pop(key, None)
+            self.__content[key] = value
+            while len(self.__content) > self.max_size:
+                self.__content.popitem(last=False)
+
+    def resize(self, max_size):
+        """
+        Change the maximum number of elements. The least recently used ones
+        are dropped if required.
+        """
+        with self.__lock:
+            self.max_size = max_size
+            while len(self.__content) > self.max_size:
+                self.__content.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__content
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__content)
+
+    def pop(self, key, default=None):
+        """
+        Remove the value associated to the key, and returns it
+        """
+        with self.__lock:
+            return self.__content.pop(key, default)
+
+    def clear(self):
+        """
+        Drop all the values
+        """
+        with self.__lock:
+            self.__content.clear()
@@ -0,0 +1,88 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+import Image
+import pyocr.builders
+
+from paperwork.backend.common import boxcache
+from paperwork.backend.common.doc import BasicDoc
+from paperwork.backend.docsearch import _get_doc_date
+from paperwork.backend.docsearch import DocSearch
+from paperwork.backend.img.doc import ImgDoc
+
+
+DOCID = "20130101_0000_00"
+
+
+class TestAsYouTypeSearch(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="paperwork-tests-")
+        self.xdg_data_home = os.getenv("XDG_DATA_HOME")
+        os.environ["XDG_DATA_HOME"] = os.path.join(self.tmpdir, "data")
+
+        rootdir = os.path.join(self.tmpdir, "papers")
+        docpath = os.path.join(rootdir, DOCID)
+        os.makedirs(docpath)
+        img = Image.new("RGB", (100, 100), "#FFFFFF")
+        img.save(os.path.join(docpath, "paper.1.jpg"))
+        words = [pyocr.builders.Box(u"electricity", ((0, 0), (50, 10))),
+                 pyocr.builders.Box(u"invoice", ((60, 0), (100, 10)))]
+        boxcache.write_boxes(os.path.join(docpath, "paper.1.words"),
+                             os.path.join(docpath, "paper.1.boxes"),
+                             [pyocr.builders.LineBox(words,
+                                                     ((0, 0), (100, 10)))])
+
+        self.docsearch = DocSearch(rootdir)
+        doc = ImgDoc(docpath, DOCID)
+        self.docsearch.index_page(doc.pages[0])
+        self.docsearch.flush_index()
+
+    def tearDown(self):
+        if self.xdg_data_home is None:
+            del os.environ["XDG_DATA_HOME"]
+        else:
+            os.environ["XDG_DATA_HOME"] = self.xdg_data_home
+        shutil.rmtree(self.tmpdir)
+
+    def __find_docids(self, sentence):
+        docs = self.docsearch.find_documents(sentence, as_you_type=True)
+        return [doc.docid for doc in docs]
+
+    def test_prefix(self):
+        self.assertEqual(self.__find_docids(u"electr"), [DOCID])
+        self.assertEqual(self.__find_docids(u"electricity inv"), [DOCID])
+        self.assertEqual(self.__find_docids(u"electricity bill"), [])
+
+    def test_nothing_to_look_for(self):
+        # only stop words or words too short: must not match every document
+        self.assertEqual(self.__find_docids(u"the "), [])
+        self.assertEqual(self.__find_docids(u"a"), [])
+        self.assertEqual(self.__find_docids(u"of the "), [])
+
+
+class TestDocDate(unittest.TestCase):
+    def __get_date(self, docid):
+        return _get_doc_date(BasicDoc("/nowhere/%s" % docid, docid))
+
+    def test_date(self):
+        self.assertEqual(self.__get_date("20130102_1234_56"),
+                         datetime.datetime(2013, 1, 2, 12, 34, 56))
+        self.assertEqual(self.__get_date("20130102_foo"),
+                         datetime.datetime(2013, 1, 2))
+
+    def test_invalid_date(self):
+        self.assertEqual(self.__get_date("20131340_foo"),
+                         datetime.datetime(*BasicDoc.DEFAULT_DATE))
+        self.assertEqual(self.__get_date("foo"),
+                         datetime.datetime(*BasicDoc.DEFAULT_DATE))
+
+
+if __name__ == "__main__":
+    unittest.main()
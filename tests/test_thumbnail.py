@@ -0,0 +1,92 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "src"))
+
+import Image
+
+from paperwork.backend.common.thumbnail import ThumbnailCache
+
+
+class FakeDoc(object):
+    docid = "20130101_0000_00"
+
+
+class FakePage(object):
+    def __init__(self, src_path):
+        self.doc = FakeDoc()
+        self.page_nb = 0
+        self.src_path = src_path
+        self.nb_thumbnails = 0
+
+    def _get_thumbnail_src_path(self):
+        return self.src_path
+
+    def _get_thumbnail(self, width):
+        self.nb_thumbnails += 1
+        return Image.new("RGB", (width, width * 2), "#FF0000")
+
+
+class TestThumbnailCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="paperwork-tests-")
+        self.cache_dir = os.path.join(self.tmpdir, "thumbnails")
+        # the mtime of a new file usually has a nanosecond precision
+        src_path = os.path.join(self.tmpdir, "paper.1.jpg")
+        Image.new("RGB", (100, 200), "#FF0000").save(src_path)
+        self.page = FakePage(src_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_disk_cache(self):
+        thumbnail = ThumbnailCache(self.cache_dir).get_thumbnail(self.page,
+                                                                 50)
+        self.assertEqual(thumbnail.size, (50, 100))
+        self.assertEqual(self.page.nb_thumbnails, 1)
+
+        # new cache --> empty memory cache: the thumbnail must be loaded from
+        # the disk instead of being generated again
+        thumbnail = ThumbnailCache(self.cache_dir).get_thumbnail(self.page,
+                                                                 50)
+        self.assertEqual(thumbnail.size, (50, 100))
+        self.assertEqual(self.page.nb_thumbnails, 1)
+
+    def test_outdated(self):
+        ThumbnailCache(self.cache_dir).get_thumbnail(self.page, 50)
+        src_mtime = os.stat(self.page.src_path).st_mtime
+        os.utime(self.page.src_path, (src_mtime + 10, src_mtime + 10))
+        ThumbnailCache(self.cache_dir).get_thumbnail(self.page, 50)
+        self.assertEqual(self.page.nb_thumbnails, 2)
+
+    def test_replaced_same_mtime(self):
+        # coarse mtimes (FAT, ...): the page is replaced, but its source file
+        # keeps the same mtime
+        ThumbnailCache(self.cache_dir).get_thumbnail(self.page, 50)
+        src_mtime = os.stat(self.page.src_path).st_mtime
+        new_path = os.path.join(self.tmpdir, "paper.2.jpg")
+        Image.new("RGB", (300, 600), "#00FF00").save(new_path)
+        os.utime(new_path, (src_mtime, src_mtime))
+        os.rename(new_path, self.page.src_path)
+        ThumbnailCache(self.cache_dir).get_thumbnail(self.page, 50)
+        self.assertEqual(self.page.nb_thumbnails, 2)
+        # the outdated thumbnail has been removed
+        doc_dirs = os.listdir(self.cache_dir)
+        self.assertEqual(len(doc_dirs), 1)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.cache_dir, doc_dirs[0]))), 1)
+
+    def test_remove_doc(self):
+        cache = ThumbnailCache(self.cache_dir)
+        cache.get_thumbnail(self.page, 50)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        cache.remove_doc(self.page.doc.docid)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+if __name__ == "__main__":
+    unittest.main()